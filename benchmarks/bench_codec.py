@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+"""
+Compares the cost and size of the consent cookie codecs.
+
+Run from the repository root with: python -m benchmarks.bench_codec --output results.json
+"""
+
+from datetime import datetime
+
+from werkzeug.http import dump_cookie
+
+from flask_consent import Consent, ConsentCookie, CompactCookieCodec, JsonCookieCodec
+
+from .common import argument_parser, Results
+
+
+def main():
+    args = argument_parser(__doc__, number=100000).parse_args()
+    results = Results(args)
+
+    consent = Consent()
+    consent.add_standard_categories()
+    categories = consent.categories
+    cookie = ConsentCookie({'required', 'preferences'}, datetime.utcnow())
+
+    for name, codec in (('json', JsonCookieCodec()), ('compact', CompactCookieCodec())):
+        value = codec.encode(categories, cookie)
+        header = len(dump_cookie('_consent', value))
+        results.run('codec/{}/encode'.format(name), lambda: codec.encode(categories, cookie), header_bytes=header)
+        results.run('codec/{}/decode'.format(name), lambda: codec.decode(categories, value), header_bytes=header)
+
+    results.write()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+"""
+Measures the per request overhead of Flask-Consent.
+
+Run from the repository root with: python -m benchmarks.bench_requests --output results.json
+"""
+
+from datetime import datetime, timedelta
+
+from flask import Flask, jsonify, request, render_template_string
+
+from flask_consent import Consent, ConsentCookie, ConsentData
+
+from .common import argument_parser, Results
+
+PAGE = '<html><head>{{ flask_consent_code() }}</head><body></body></html>'
+BANNER = '''
+{% for category in flask_consent_categories %}
+<input type="checkbox" id="category_{{ category.name }}" {% if category.default %}checked="checked"{% endif %}
+       name="flask_consent_category" value="{{ category.name }}"/>
+<label for="category_{{ category.name }}">{{ category.title }}</label>
+{% endfor %}
+<button id="flask_consent_banner_close">OK</button>
+'''
+
+
+def make_app(with_consent=True, categories=3, domains=0):
+    app = Flask(__name__)
+    app.config['CONSENT_PRIMARY_SERVERNAME'] = 'primary.test'
+    app.config['CONSENT_FULL_TEMPLATE'] = 'full.html'
+    app.config['CONSENT_BANNER_TEMPLATE'] = 'banner.html'
+    consent = None
+    if with_consent:
+        consent = Consent(app)
+        consent.set_render_template_func(lambda template, **kwargs: render_template_string(BANNER, **kwargs))
+        for i in range(categories):
+            consent.add_category('category{}'.format(i), 'Category {}'.format(i), 'Description', default=i % 2 == 0)
+        domain_list = ['domain{}.test'.format(i) for i in range(domains)]
+        consent.domain_loader(lambda: domain_list)
+
+    @app.route('/')
+    def plain():
+        return 'OK'
+
+    @app.route('/reads-consent')
+    def reads_consent():
+        return jsonify(enabled=request.consent['category0'] if with_consent else True)
+
+    @app.route('/page')
+    def page():
+        if with_consent:
+            return render_template_string(PAGE)
+        return render_template_string(PAGE, flask_consent_code=lambda: '')
+
+    return app, consent
+
+
+def cookie_headers(app, consent, age: timedelta = None):
+    if age is None:
+        return {}
+    value = consent.cookie_codec.encode(consent.categories, ConsentCookie({'category0'}, datetime.utcnow() - age))
+    return {'Cookie': '{}={}'.format(app.config['CONSENT_COOKIE_NAME'], value)}
+
+
+def bench_requests(results: Results):
+    app, _ = make_app(with_consent=False)
+    client = app.test_client(use_cookies=False)
+    for path in ('/', '/reads-consent', '/page'):
+        results.run('request/baseline{}'.format(path), lambda: client.get(path))
+
+    app, consent = make_app()
+    client = app.test_client(use_cookies=False)
+    cookies = dict(absent=None, fresh=timedelta(days=1), stale=timedelta(days=800))
+    for cookie, age in cookies.items():
+        headers = cookie_headers(app, consent, age)
+        for path in ('/', '/reads-consent', '/page'):
+            results.run('request/consent/{}{}'.format(cookie, path), lambda: client.get(path, headers=headers))
+
+
+def bench_consent_data(results: Results):
+    app, consent = make_app()
+    state = app.extensions['consent']
+    for cookie, age in dict(absent=None, fresh=timedelta(days=1)).items():
+        with app.test_request_context(headers=cookie_headers(app, consent, age)):
+            def construct():
+                return ConsentData(state)
+
+            def construct_and_read():
+                return ConsentData(state)['category0']
+
+            def read_repeatedly():
+                data = ConsentData(state)
+                for _ in range(20):
+                    data['category0']
+
+            def read_decisions_repeatedly():
+                decisions = ConsentData(state).decisions
+                for _ in range(20):
+                    decisions.category0
+
+            def change_and_finalize():
+                data = ConsentData(state)
+                data['category1'] = not data['category1']
+                data.finalize(app.response_class())
+
+            results.run('consent_data/{}/construct'.format(cookie), construct, number=10000)
+            results.run('consent_data/{}/construct_and_read'.format(cookie), construct_and_read, number=10000)
+            results.run('consent_data/{}/read_20'.format(cookie), read_repeatedly, number=10000)
+            results.run('consent_data/{}/read_20_decisions'.format(cookie), read_decisions_repeatedly, number=10000)
+            results.run('consent_data/{}/change_and_finalize'.format(cookie), change_and_finalize)
+
+
+def bench_html(results: Results):
+    for categories in (3, 30, 300):
+        for domains in (1, 50):
+            app, consent = make_app(categories=categories, domains=domains)
+            state = app.extensions['consent']
+            with app.test_request_context('/page'):
+                app.preprocess_request()
+                results.run('html/{}_categories/{}_domains'.format(categories, domains), state.html,
+                            categories=categories, domains=domains)
+
+
+def bench_consent_route(results: Results):
+    app, consent = make_app()
+    client = app.test_client(use_cookies=False)
+    headers = cookie_headers(app, consent, timedelta(days=1))
+    results.run('consent_route/get_json',
+                lambda: client.get('/consent', headers=headers, content_type='application/json'))
+    results.run('consent_route/post_unchanged',
+                lambda: client.post('/consent', headers=headers, json=['category0']))
+    results.run('consent_route/post_changed',
+                lambda: client.post('/consent', headers=headers, json=['category0', 'category1']))
+    results.run('consent_route/preflight',
+                lambda: client.options('/consent', headers={'Origin': 'https://primary.test'}))
+
+
+def main():
+    args = argument_parser(__doc__).parse_args()
+    results = Results(args)
+    bench_requests(results)
+    bench_consent_data(results)
+    bench_html(results)
+    bench_consent_route(results)
+    results.write()
+
+
+if __name__ == '__main__':
+    main()
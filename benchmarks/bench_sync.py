@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+"""
+Simulates visitors synchronizing consent between domains, end to end over HTTP.
+
+Every domain is its own app, served by Werkzeug on a loopback port. Virtual visitors replay what consent.js does in
+the browser (the XHR flow), with a cookie jar per domain, and the harness reports the number of requests, latencies and
+the bytes transferred per completed synchronization.
+
+Run from the repository root with: python -m benchmarks.bench_sync --visitors 1000 --concurrency 50 --output sync.json
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import math
+import random
+import re
+import sys
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from time import perf_counter
+
+from flask import Flask, render_template_string
+from werkzeug.serving import make_server
+
+from flask_consent import Consent
+
+from .common import meta, write_json
+
+PAGE = '<html><head>{{ flask_consent_code() }}</head><body></body></html>'
+CONFIG_RE = re.compile(r'<script type="application/json" id="flask_consent_config">(.*?)</script>', re.S)
+PRIMARY = 'primary.test'
+
+#: request kinds that are part of the protocol, as opposed to preparing or checking the visitor's state
+PROTOCOL_KINDS = ('page', 'primary_get', 'token_post', 'consent_post')
+
+
+def make_domain_app(domains: list, secret_key: str = None) -> Flask:
+    app = Flask(__name__)
+    app.testing = True  # cookies without the secure flag, we're on plain HTTP
+    app.secret_key = secret_key
+    app.config['CONSENT_PRIMARY_SERVERNAME'] = PRIMARY
+    app.config['CONSENT_BANNER_TEMPLATE'] = 'banner.html'
+    app.config['CONSENT_METRICS'] = False
+    consent = Consent(app)
+    consent.set_render_template_func(lambda template, **kwargs: '<button id="flask_consent_banner_close"/>')
+    consent.add_standard_categories()
+    others = [domain for domain in domains if domain != PRIMARY]
+    consent.domain_loader(lambda: others)
+
+    @app.route('/')
+    def page():
+        return render_template_string(PAGE)
+
+    return app
+
+
+class Network:
+    def __init__(self, domains: int, secret_key: str = None):
+        """Starts one threaded Werkzeug server per domain, the first one being the primary domain."""
+        self.names = [PRIMARY] + ['domain{}.test'.format(i) for i in range(1, domains)]
+        self.categories = ['required', 'preferences', 'analytics']
+        self.ports = {}
+        self._servers = []
+        for name in self.names:
+            server = make_server('127.0.0.1', 0, make_domain_app(self.names, secret_key), threaded=True)
+            server.request_queue_size = 1024
+            self.ports[name] = server.server_port
+            self._servers.append(server)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def close(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()  # type: Counter
+        self.bytes = Counter()  # type: Counter
+        self.latencies = {}  # type: dict
+        self.outcomes = Counter()  # type: Counter
+
+    def record(self, kind: str, seconds: float, size: int):
+        with self._lock:
+            self.requests[kind] += 1
+            self.bytes[kind] += size
+            self.latencies.setdefault(kind, []).append(seconds)
+
+    def outcome(self, name: str):
+        with self._lock:
+            self.outcomes[name] += 1
+
+    def summary(self) -> dict:
+        def percentile(values, p):
+            # nearest rank, statistics.quantiles needs Python 3.8
+            if not values:
+                return None
+            ordered = sorted(values)
+            return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))] * 1e3
+
+        completed = sum(count for name, count in self.outcomes.items() if name != 'failed')
+        protocol_bytes = sum(self.bytes[kind] for kind in PROTOCOL_KINDS)
+        protocol_requests = sum(self.requests[kind] for kind in PROTOCOL_KINDS)
+        return dict(
+            outcomes=dict(self.outcomes),
+            requests={kind: dict(count=self.requests[kind], bytes=self.bytes[kind],
+                                 p50_ms=percentile(values, 50), p99_ms=percentile(values, 99))
+                      for kind, values in sorted(self.latencies.items())},
+            requests_per_sync=protocol_requests / completed if completed else None,
+            bytes_per_sync=protocol_bytes / completed if completed else None,
+        )
+
+
+class Visitor:
+    def __init__(self, network: Network, stats: Stats, rng: random.Random):
+        """A browser with a cookie jar per domain, running the same protocol as consent.js."""
+        self.network = network
+        self.stats = stats
+        self.rng = rng
+        self.jars = {name: SimpleCookie() for name in network.names}
+
+    def request(self, kind: str, domain: str, method: str, path: str, payload=None, origin: str = None):
+        headers = {'Host': domain}
+        cookies = '; '.join('{}={}'.format(key, morsel.coded_value) for key, morsel in self.jars[domain].items())
+        if cookies:
+            headers['Cookie'] = cookies
+        if origin:
+            headers['Origin'] = 'http://' + origin
+        body = None
+        if payload is not None or kind == 'primary_get':
+            headers['Content-Type'] = 'application/json'
+        if payload is not None:
+            body = json.dumps(payload).encode('utf-8')
+
+        start = perf_counter()
+        connection = http.client.HTTPConnection('127.0.0.1', self.network.ports[domain], timeout=60)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        duration = perf_counter() - start
+
+        for value in response.msg.get_all('Set-Cookie') or []:
+            self.jars[domain].load(value)
+        sent = len(method) + len(path) + sum(len(k) + len(v) + 4 for k, v in headers.items()) + len(body or b'')
+        received = sum(len(k) + len(v) + 4 for k, v in response.getheaders()) + len(data)
+        self.stats.record(kind, duration, sent + received)
+        return response.status, data
+
+    def page(self, domain: str, kind: str = 'page') -> dict:
+        _, data = self.request(kind, domain, 'GET', '/')
+        match = CONFIG_RE.search(data.decode('utf-8'))
+        # pages with fresh consent don't include the consent code at all
+        return json.loads(match.group(1)) if match else dict(stale=False)
+
+    def send_consent(self, config: dict, payload):
+        for domain in config['domains']:
+            self.request('consent_post', domain, 'POST', config['consent_url'], payload, origin=self.domain)
+
+    def visit(self, domain: str) -> str:
+        """Loads a page and does what the script would do, returning how consent ended up on the domain."""
+        self.domain = domain
+        config = self.page(domain)
+        if not config['stale']:
+            return 'fresh'
+        if not config['is_primary']:
+            status, data = self.request('primary_get', PRIMARY, 'GET', config['consent_url'], origin=domain)
+            response = json.loads(data) if status == 200 else {}
+            if response.get('token'):
+                status, _ = self.request('token_post', domain, 'POST', config['consent_url'],
+                                         dict(token=response['token']))
+                return 'token' if status == 200 and not self.page(domain)['stale'] else 'failed'
+            if not response.get('stale', True) and response.get('enabled'):
+                self.send_consent(config, response['enabled'])
+                return 'legacy' if not self.page(domain)['stale'] else 'failed'
+        # the visitor is shown the banner and makes a choice
+        categories = self.network.categories
+        enabled = ['required'] + [c for c in categories[1:] if self.rng.random() < 0.5]
+        self.send_consent(config, dict(enabled=enabled, categories=categories))
+        return 'banner' if not self.page(self.rng.choice(config['domains']), kind='verify')['stale'] else 'failed'
+
+
+def simulate(network: Network, scenario: str, visitors: int, concurrency: int, seed: int) -> dict:
+    stats = Stats()
+
+    def run(i):
+        visitor = Visitor(network, stats, random.Random(seed + i))
+        try:
+            if scenario == 'returning':
+                # consent was given on the primary domain in an earlier session
+                visitor.domain = PRIMARY
+                visitor.request('setup', PRIMARY, 'POST', '/consent', ['required'])
+            stats.outcome(visitor.visit(visitor.rng.choice(network.names[1:])))
+        except Exception as e:
+            print('visitor {} failed: {!r}'.format(i, e), file=sys.stderr)
+            stats.outcome('failed')
+
+    start = perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(run, range(visitors)))
+    result = stats.summary()
+    result.update(visitors=visitors, concurrency=concurrency, seconds=perf_counter() - start)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--domains', type=int, default=5, help='number of domains, including the primary one')
+    parser.add_argument('--visitors', type=int, default=1000, help='virtual visitors per scenario')
+    parser.add_argument('--concurrency', type=int, default=50, help='visitors running at the same time')
+    parser.add_argument('--scenario', action='append', choices=['new', 'returning'],
+                        help='new visitors decide on the banner, returning ones synchronize from the primary domain')
+    parser.add_argument('--no-secret-key', action='store_true', help='use the legacy flow without signed tokens')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as JSON to this file ("-" for stdout)')
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    network = Network(args.domains, secret_key=None if args.no_secret_key else 'bench-sync')
+    results = {}
+    try:
+        for scenario in args.scenario or ['new', 'returning']:
+            results[scenario] = result = simulate(network, scenario, args.visitors, args.concurrency, args.seed)
+            print('{:<10} {:>6.1f} requests/sync {:>8.0f} bytes/sync  outcomes: {}'.format(
+                scenario, result['requests_per_sync'] or 0, result['bytes_per_sync'] or 0,
+                ', '.join('{}={}'.format(k, v) for k, v in sorted(result['outcomes'].items()))), file=sys.stderr)
+            for kind, request in result['requests'].items():
+                print('  {:<14} {:>7} requests  p50 {:>7.2f} ms  p99 {:>7.2f} ms'.format(
+                    kind, request['count'], request['p50_ms'], request['p99_ms']), file=sys.stderr)
+    finally:
+        network.close()
+    if args.output:
+        write_json(dict(meta=meta(), domains=args.domains, results=results), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+"""Helpers shared by the benchmarks."""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import timeit
+from datetime import datetime
+
+import flask
+
+import flask_consent
+
+
+def argument_parser(description: str, number: int = 1000) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--number', type=int, default=number, help='calls per timing run')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timing runs')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('--output', help='write the results as JSON to this file ("-" for stdout)')
+    return parser
+
+
+def measure(func, number: int, repeat: int) -> dict:
+    """Times func, returning the per call timings in microseconds."""
+    func()  # warm up caches, just like a real worker would be after its first request
+    runs = [t / number * 1e6 for t in timeit.repeat(func, number=number, repeat=repeat)]
+    return dict(number=number, repeat=repeat, min_us=min(runs), median_us=statistics.median(runs), max_us=max(runs))
+
+
+def meta() -> dict:
+    """Describes the environment the benchmarks ran in."""
+    return dict(
+        timestamp=datetime.utcnow().isoformat(),
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        flask=getattr(flask, '__version__', None),
+        flask_consent=flask_consent.__version__,
+    )
+
+
+def write_json(data: dict, output: str):
+    if output == '-':
+        json.dump(data, sys.stdout, indent=2)
+    else:
+        with open(output, 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+class Results:
+    def __init__(self, args):
+        self.args = args
+        self.results = {}
+
+    def run(self, name: str, func, number: int = None, **extra):
+        if self.args.filter not in name:
+            return
+        result = measure(func, number or self.args.number, self.args.repeat)
+        result.update(extra)
+        self.results[name] = result
+        print('{:<50} {:>10.2f} us'.format(name, result['median_us']), file=sys.stderr)
+
+    def write(self):
+        if not self.args.output:
+            return
+        write_json(dict(meta=meta(), results=self.results), self.args.output)
@@ -5,19 +5,63 @@
 
 """This package provides the Flask extension Consent and some supporting classes."""
 
-import json
+import hmac
+import inspect
+import secrets
+import threading
 from collections import OrderedDict
+from collections.abc import Mapping
 from dataclasses import dataclass
 from datetime import timedelta, datetime
+from functools import wraps
+from hashlib import sha256
 from importlib.resources import read_text
-from typing import Callable, Iterable, List, Set
+from time import perf_counter
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+from urllib.parse import urlencode, urlsplit, urlunsplit
 
-from flask import current_app, render_template_string, render_template, request, jsonify, Flask, Response
+from flask import (abort, current_app, has_request_context, redirect, render_template, request, jsonify, url_for,
+                   Blueprint, Flask, Response)
 from markupsafe import Markup
+from werkzeug.local import LocalProxy
 
+from .audit import AuditEvent, AuditLog
+from .cli import consent_cli
+from .codec import ConsentCookie, ConsentCookieCodec, CompactCookieCodec, JsonCookieCodec
+from .domains import DomainCache
+from .metrics import MetricsRegistry, code_rendered, consent_requested, cookie_decoded, render_prometheus
+from .store import ConsentStore, StoredConsent
+from .sync import SyncTokens
 from .version import version as _version
 
 __version__ = _version
+__all__ = ['Consent', 'ConsentCategory', 'ConsentData', 'ConsentDecisions', 'ConsentCookie', 'ConsentCookieCodec',
+           'CompactCookieCodec', 'JsonCookieCodec', 'consent_required']
+
+# the number of renderings of the full consent page kept when CONSENT_CACHE_FULL_PAGE is enabled
+PAGE_CACHE_SIZE = 64
+# the number of banner variants (one per set of undecided categories) kept per set of categories
+BANNER_CACHE_SIZE = 16
+
+
+def _now() -> datetime:
+    # consent timestamps are kept at the precision of the compact cookie, so they compare equal after a round trip
+    return datetime.utcnow().replace(microsecond=0)
+
+
+def _etag(key: tuple) -> str:
+    return sha256(repr(key).encode('utf-8')).hexdigest()[:32]
+
+
+def _local_url(url: str) -> str:
+    """Returns url if it is a path on this host, otherwise the root, to not redirect anywhere else."""
+    # browsers treat backslashes like slashes and ignore tabs and newlines, so /\evil.test would leave the host
+    if any(c == '\\' or ord(c) < 0x20 or ord(c) == 0x7f for c in url):
+        return '/'
+    if not url.startswith('/') or url.startswith('//'):
+        return '/'
+    parts = urlsplit(url)
+    return '/' if parts.scheme or parts.netloc else url
 
 
 @dataclass(frozen=True)
@@ -29,6 +73,36 @@ class ConsentCategory:
     description: str
     default: bool
     is_required: bool
+    index: int = 0
+
+
+class ConsentSettings:
+    __slots__ = ('full_template', 'banner_template', 'contact_mail', 'cookie_name', 'valid_for', 'max_age',
+                 'primary_servername', 'primary_domain', 'cache_banner', 'cache_full_page', 'cacheable', 'metrics',
+                 'exempt', 'domains_ttl', 'domains_stale_ttl', 'cors_max_age', 'sync_mode', 'sync_token_max_age')
+
+    def __init__(self, config: dict):
+        """A snapshot of the CONSENT_* configuration options, with derived values precomputed."""
+        self.full_template = config['CONSENT_FULL_TEMPLATE']
+        self.banner_template = config['CONSENT_BANNER_TEMPLATE']
+        self.contact_mail = config['CONSENT_CONTACT_MAIL']
+        self.cookie_name = config['CONSENT_COOKIE_NAME']
+        self.valid_for = timedelta(days=int(config['CONSENT_VALID_FOR_MONTHS']) / 12 * 365)
+        self.max_age = int(self.valid_for.days * 24 * 60 * 60)
+        self.primary_servername = config.get('CONSENT_PRIMARY_SERVERNAME') or config.get('SERVER_NAME')
+        self.primary_domain = self.primary_servername.split(':')[0] if self.primary_servername else None
+        self.cache_banner = bool(config['CONSENT_CACHE_BANNER'])
+        self.cache_full_page = bool(config['CONSENT_CACHE_FULL_PAGE'])
+        self.cacheable = bool(config['CONSENT_CACHEABLE'])
+        self.metrics = bool(config['CONSENT_METRICS'])
+        self.exempt = frozenset(config['CONSENT_EXEMPT'])
+        self.domains_ttl = config['CONSENT_DOMAINS_TTL']
+        self.domains_stale_ttl = config['CONSENT_DOMAINS_STALE_TTL']
+        self.cors_max_age = str(config['CONSENT_CORS_MAX_AGE'])
+        self.sync_mode = config['CONSENT_SYNC_MODE']
+        self.sync_token_max_age = int(config['CONSENT_SYNC_TOKEN_MAX_AGE'])
+        if self.sync_mode not in ('xhr', 'redirect'):
+            raise ValueError('CONSENT_SYNC_MODE needs to be either xhr or redirect')
 
 
 class ConsentExtensionState:
@@ -36,92 +110,485 @@ class ConsentExtensionState:
         """Used internally."""
         self.extension = extension  # type: Consent
         self.app = app  # type: Flask
+        self.settings = ConsentSettings(app.config)
+        self._injection_template = None
+        self._script = None
+        self._exempt = (None, {})
+        self._default_consent = (None, None)
+        self.domain_cache = DomainCache(self)
+        self._banner_cache = (None, None)
+        self._page_cache = OrderedDict()  # type: OrderedDict
+        self._page_lock = threading.Lock()
+        self._sync_tokens = (None, None)
+        self.metrics = MetricsRegistry(enabled=self.settings.metrics)
+
+    def reload_settings(self):
+        """Takes a new snapshot of the configuration and drops everything derived from it."""
+        self.settings = ConsentSettings(self.app.config)
+        self.metrics.enabled = self.settings.metrics
+        self._exempt = (None, {})
+        self._banner_cache = (None, None)
+        with self._page_lock:
+            self._page_cache.clear()
+        self.domain_cache.invalidate()
 
     @property
     def full_template(self):
-        return self.app.config['CONSENT_FULL_TEMPLATE']
+        return self.settings.full_template
 
     @property
     def banner_template(self):
-        return self.app.config['CONSENT_BANNER_TEMPLATE']
+        return self.settings.banner_template
 
     @property
     def contact_mail(self):
-        return self.app.config['CONSENT_CONTACT_MAIL']
+        return self.settings.contact_mail
 
     @property
     def cookie_name(self):
-        return self.app.config['CONSENT_COOKIE_NAME']
+        return self.settings.cookie_name
 
     @property
     def valid_for(self):
-        return timedelta(days=int(self.app.config['CONSENT_VALID_FOR_MONTHS']) / 12 * 365)
+        return self.settings.valid_for
 
     @property
     def primary_servername(self):
-        val = self.app.config.get('CONSENT_PRIMARY_SERVERNAME', self.app.config.get('SERVER_NAME'))
+        val = self.settings.primary_servername
         assert val, 'you need to set CONSENT_PRIMARY_SERVERNAME or SERVER_NAME'
         return val
 
+    @property
+    def sync_tokens(self) -> Optional[SyncTokens]:
+        """Used to sign consent for synchronization between domains, None if the app has no secret key."""
+        key = (self.app.secret_key, self.settings.sync_token_max_age)
+        cached_key, tokens = self._sync_tokens
+        if cached_key != key:
+            tokens = SyncTokens(self.app.secret_key, self.settings.sync_token_max_age) if key[0] else None
+            self._sync_tokens = (key, tokens)
+        return tokens
+
+    @property
+    def injection_template(self):
+        """The compiled injection template, loaded and compiled on first use."""
+        if self._injection_template is None:
+            self._injection_template = self.app.jinja_env.from_string(read_text(__name__, 'injection.html'))
+        return self._injection_template
+
+    def banner(self, undecided: Iterable[str] = None):
+        """
+        Renders the banner template, with only the undecided categories if given.
+
+        The result only depends on the categories, the contact mail and the render function, so it is cached
+        until any of those change (unless CONSENT_CACHE_BANNER is disabled).
+        """
+        settings = self.settings
+        key = (self.extension._categories_version, settings.banner_template, settings.contact_mail,
+               self.extension._render_template_func)
+        variant = None if undecided is None else frozenset(undecided)
+        cached_key, cache = self._banner_cache
+        if cached_key != key:
+            cache = {}
+            self._banner_cache = (key, cache)
+        elif variant in cache:
+            return cache[variant]
+        categories = self.extension.categories.values()
+        if variant is not None:
+            categories = [c for c in categories if c.name in variant]
+        result = self.extension._render_template_func(
+            settings.banner_template,
+            flask_consent_contact_mail=settings.contact_mail,
+            flask_consent_categories=categories)
+        if settings.cache_banner and len(cache) < BANNER_CACHE_SIZE:
+            cache[variant] = result
+        return result
+
+    def page_key(self, consent: 'ConsentData') -> tuple:
+        """
+        Everything the full consent page depends on, used both for its ETag and as the key of the page cache.
+
+        The render function is identified by name rather than identity, so that the ETag is the same in all
+        worker processes.
+        """
+        settings = self.settings
+        func = self.extension._render_template_func
+        stale = consent.is_stale()
+        return (self.extension._categories_version, settings.full_template, settings.contact_mail,
+                getattr(func, '__module__', None), getattr(func, '__qualname__', None),
+                tuple(sorted(consent.enabled)), None if stale else consent.last_updated.isoformat(),
+                request.host, self.script[1], tuple(self.extension._request_domains()))
+
+    def full_page(self, key: tuple):
+        """Renders the full consent page, reusing an earlier rendering for the same key."""
+        with self._page_lock:
+            if key in self._page_cache:
+                self._page_cache.move_to_end(key)
+                return self._page_cache[key]
+        result = self.extension._render_template_func(
+            self.settings.full_template,
+            flask_consent_categories=self.extension.categories.values(),
+            flask_consent_contact_mail=self.settings.contact_mail)
+        if isinstance(result, str):
+            with self._page_lock:
+                self._page_cache[key] = result
+                while len(self._page_cache) > PAGE_CACHE_SIZE:
+                    self._page_cache.popitem(last=False)
+        return result
+
+    @staticmethod
+    def _banner_categories(stale: Optional[bool]) -> Optional[Set[str]]:
+        if stale and request.consent.is_partially_stale():
+            return request.consent.undecided
+        return None
+
+    def is_exempt(self, endpoint: Optional[str]) -> bool:
+        """
+        Whether the consent hooks should be skipped for the given endpoint.
+
+        The result is computed once per endpoint and then looked up, until the exemptions are changed.
+        """
+        version, cache = self._exempt
+        if version != self.extension._exempt_version:
+            cache = {}
+            self._exempt = (self.extension._exempt_version, cache)
+        try:
+            return cache[endpoint]
+        except KeyError:
+            result = cache[endpoint] = self._compute_exempt(endpoint)
+            return result
+
+    def _compute_exempt(self, endpoint: Optional[str]) -> bool:
+        if endpoint is None or endpoint == 'flask_consent':
+            return False
+        names = self.settings.exempt | self.extension._exempt_names
+        parts = endpoint.split('.')
+        if any('.'.join(parts[:i]) in names for i in range(1, len(parts) + 1)):
+            return True
+        if getattr(self.app.view_functions.get(endpoint), '_flask_consent_exempt', False):
+            return True
+        prefixes = tuple(name for name in names if name.startswith('/'))
+        if prefixes and any(rule.rule.startswith(prefixes) for rule in self.app.url_map.iter_rules(endpoint)):
+            return True
+        return any(predicate(endpoint) for predicate in self.extension._exempt_predicates)
+
+    @property
+    def default_consent(self) -> 'DefaultConsentData':
+        """The consent data used on exempt endpoints, computed once per set of categories."""
+        version, data = self._default_consent
+        if version != self.extension._categories_version:
+            data = DefaultConsentData(self)
+            self._default_consent = (self.extension._categories_version, data)
+        return data
+
+    @property
+    def script(self) -> Tuple[str, str]:
+        """The static consent JavaScript and a hash of its content, used to version its URL."""
+        if self._script is None:
+            source = read_text(__name__, 'consent.js')
+            self._script = (source, sha256(source.encode('utf-8')).hexdigest()[:16])
+        return self._script
+
+    def warmup(self) -> Dict[str, Optional[float]]:
+        """
+        Does the work otherwise left to the first requests, returning the seconds each step took.
+
+        Needs a request context. Steps that fail are logged and reported as None, so that a broken domain loader
+        doesn't keep a worker from starting.
+        """
+        jinja_env = self.app.jinja_env
+        settings = self.settings
+        steps = [
+            ('injection_template', lambda: self.injection_template),
+            ('script', lambda: self.script),
+            ('exemptions', lambda: [self.is_exempt(endpoint) for endpoint in self.app.view_functions]),
+            ('default_consent', lambda: self.default_consent),
+        ]
+        if settings.banner_template:
+            steps.append(('banner', self.banner))
+        if settings.full_template:
+            steps.append(('full_template', lambda: jinja_env.get_template(settings.full_template)))
+        if settings.domains_ttl:
+            # without a TTL the domain loader is called on every render, so there's nothing to keep
+            steps.append(('domains', self.domain_cache.get))
+
+        timings = {}
+        for name, func in steps:
+            start = perf_counter()
+            try:
+                func()
+            except Exception:
+                self.app.logger.exception('consent warmup step %s failed', name)
+                timings[name] = None
+            else:
+                timings[name] = perf_counter() - start
+        return timings
+
     def html(self):
-        primary_domain = self.primary_servername.split(':')[0]
-        if request.endpoint == 'flask_consent' or request.consent.is_stale():
-            return Markup(render_template_string(
-                read_text(__name__, 'injection.html'),
-                flask_consent_banner=self.extension._render_template_func(
-                    self.banner_template,
-                    flask_consent_contact_mail=self.contact_mail,
-                    flask_consent_categories=self.extension.categories.values()),
-                flask_consent_contact_mail=self.contact_mail,
-                flask_consent_primary_domain=primary_domain,
-                flask_consent_domains=self.extension.domains + [primary_domain]
-            ))
+        start = perf_counter()
+        settings = self.settings
+        assert settings.primary_domain, 'you need to set CONSENT_PRIMARY_SERVERNAME or SERVER_NAME'
+        primary_domain = settings.primary_domain
+        is_consent_page = request.endpoint == 'flask_consent'
+        if settings.cacheable:
+            # the output may not depend on the consent cookie, the JavaScript decides if consent is stale instead
+            stale = None
+            include_banner = not is_consent_page
         else:
-            return ''
+            stale = request.consent.is_stale()
+            if not is_consent_page and not stale:
+                return ''
+            include_banner = stale and not is_consent_page
+            if stale:
+                self.metrics.inc('stale_total')
+        result = Markup(render_template(
+            self.injection_template,
+            flask_consent_include_banner=include_banner,
+            flask_consent_banner=self.banner(self._banner_categories(stale)) if include_banner else None,
+            flask_consent_config=dict(
+                domains=self.extension._request_domains() + [primary_domain],
+                primary_domain=primary_domain,
+                consent_url=url_for('flask_consent'),
+                cookie_name=settings.cookie_name,
+                stale=stale,
+                is_primary=request.headers.get('Host') == primary_domain,
+                is_consent_page=is_consent_page,
+                sync_mode=settings.sync_mode if self.sync_tokens else 'xhr',
+                sync_url=url_for('flask_consent_sync'),
+            ),
+            flask_consent_script_url=url_for('flask_consent_script', version=self.script[1])
+        ))
+        duration = perf_counter() - start
+        self.metrics.observe('render_seconds', duration)
+        if include_banner:
+            self.metrics.inc('banner_impressions_total')
+        code_rendered.send(self.app, duration=duration, banner=include_banner)
+        return result
+
+
+class ConsentDecisions(Mapping):
+    def __init__(self, values: dict):
+        """
+        An immutable snapshot of which categories are enabled, available as request.consent.decisions.
+
+        Categories can be looked up by name, by ConsentCategory or as attributes (consent.analytics in templates).
+        The values are kept in the instance dict, so attribute access is as cheap as any attribute lookup. That is
+        why Consent.add_category rejects names of the methods of Mapping (keys, items, get, ...), they'd be hidden.
+        """
+        self.__dict__.update(values)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('consent decisions are read-only, change request.consent instead')
+
+    def __delattr__(self, name):
+        raise AttributeError('consent decisions are read-only, change request.consent instead')
+
+    def __getitem__(self, key: (ConsentCategory, str)) -> bool:
+        if isinstance(key, ConsentCategory):
+            key = key.name
+        return self.__dict__[key]
+
+    def __iter__(self):
+        return iter(self.__dict__)
+
+    def __len__(self):
+        return len(self.__dict__)
+
+    def __repr__(self):
+        return 'ConsentDecisions({!r})'.format(self.__dict__)
 
 
 class ConsentData:
+    __slots__ = ('_state', '_loaded', '_inspected', '_dirty', '_enabled', '_last_updated', '_has_consent',
+                 '_decided', '_user_id', '_store_dirty', '_from_store', '_decisions')
+
     def __init__(self, state: ConsentExtensionState):
-        """This class contains the user facing API during a request. You can access it using request.consent."""
+        """
+        This class contains the user facing API during a request. You can access it using request.consent.
+
+        The consent cookie is only decoded the first time the data is actually looked at, so requests that never
+        touch request.consent don't pay for it.
+        """
 
         self._state = state
+        self._loaded = False
+        self._inspected = False
+        self._dirty = False
+        self._has_consent = False
+        self._user_id = None
+        self._store_dirty = False
+        self._from_store = False
+        self._decisions = None
 
-        data = json.loads(request.cookies.get(self._state.cookie_name, '{}'))  # type: dict
-        try:
-            self._last_updated = datetime.fromisoformat(data['last_updated'])
-        except (ValueError, KeyError):
-            self._last_updated = datetime.utcnow()
-        if self._state.cookie_name not in request.cookies or 'enabled' not in data:
-            self._enabled = {c.name for c in self._state.extension.categories.values() if c.default}
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        self._inspected = True
+
+        start = perf_counter()
+        cookie = ConsentCookie()
+        value = request.cookies.get(self._state.settings.cookie_name)
+        if value is not None:
+            cookie = self._state.extension.cookie_codec.decode(self._state.extension.categories, value)
+            status = 'present' if cookie.enabled is not None else 'invalid'
         else:
-            self._enabled = set(data['enabled']) if isinstance(data['enabled'], list) else set()
-        self._dirty = False
+            status = 'missing'
+        categories = self._state.extension.categories
+        self._has_consent = value is not None
+        self._last_updated = cookie.last_updated or datetime.utcnow()
+        if cookie.enabled is None:
+            self._enabled = {c.name for c in categories.values() if c.default}
+            self._decided = set()
+        else:
+            self._enabled = cookie.enabled
+            self._decided = set(categories) if cookie.decided is None else cookie.decided
+            # categories added since consent was given start out with their default
+            self._enabled |= {c.name for c in categories.values() if c.default and c.name not in self._decided}
+
+        if self._state.extension._store is not None:
+            self._merge_stored(cookie)
+
+        duration = perf_counter() - start
+        self._state.metrics.observe('cookie_decode_seconds', duration)
+        self._state.metrics.inc('cookies_total', status=status)
+        cookie_decoded.send(self._state.app, duration=duration, status=status)
+
+    def _merge_stored(self, cookie: ConsentCookie):
+        self._user_id = self._state.extension._user_loader()
+        if self._user_id is None:
+            return
+        stored = self._state.extension._store.get(self._user_id)
+        cookie_valid = cookie.enabled is not None and cookie.last_updated is not None
+        # compare at the precision of the compact cookie, stores and JSON cookies may keep timestamps with microseconds
+        stored_at = stored.last_updated.replace(microsecond=0) if stored is not None else None
+        cookie_at = cookie.last_updated.replace(microsecond=0) if cookie_valid else None
+        if stored is not None and (not cookie_valid or stored_at > cookie_at):
+            # the user has given consent elsewhere, update the cookie on this domain as well
+            categories = self._state.extension.categories
+            self._enabled = set(stored.enabled)
+            self._decided = set(categories) if stored.decided is None else set(stored.decided)
+            self._enabled |= {c.name for c in categories.values() if c.default and c.name not in self._decided}
+            self._last_updated = stored_at
+            self._has_consent = True
+            self._dirty = True
+            self._from_store = True
+        elif cookie_valid and (stored is None or cookie_at > stored_at):
+            # consent was given before logging in (or on a domain the store doesn't know about yet)
+            self._store_dirty = True
 
     def is_stale(self):
-        if self._state.cookie_name not in request.cookies:
+        """Whether the user needs to be asked for consent, because it is missing, expired or partially stale."""
+        return self._is_expired() or bool(self.undecided)
+
+    def is_partially_stale(self):
+        """Whether consent has been given, but categories have been added since that the user hasn't decided on."""
+        return not self._is_expired() and bool(self.undecided)
+
+    @property
+    def undecided(self) -> Set[str]:
+        """The names of the (not required) categories the user hasn't made a choice about yet."""
+        self._load()
+        return {c.name for c in self._state.extension.categories.values()
+                if not c.is_required and c.name not in self._decided}
+
+    def _is_expired(self):
+        self._inspected = True
+        no_cookie = self._state.settings.cookie_name not in request.cookies
+        if not self._loaded and self._state.extension._store is None and no_cookie:
             return True
 
-        return (self._last_updated + self._state.valid_for) < datetime.utcnow()
+        self._load()
+        if not self._has_consent:
+            return True
+        return (self._last_updated + self._state.settings.valid_for) < datetime.utcnow()
 
     def finalize(self, response):
+        if self._inspected:
+            response.vary.add('Cookie')
+        if self._user_id is not None and ((self._dirty and not self._from_store) or self._store_dirty):
+            self._state.extension._store.set(self._user_id, StoredConsent(
+                frozenset(self._enabled), self._last_updated, frozenset(self._decided)))
         if self._dirty:
-            response.set_cookie(self._state.cookie_name,
-                                json.dumps(dict(
-                                    enabled=list(self._enabled),
-                                    last_updated=self._last_updated.isoformat()
-                                )),
+            settings = self._state.settings
+            consent_endpoint = request.endpoint in ('flask_consent', 'flask_consent_sync')
+            if settings.cacheable and request.method in ('GET', 'HEAD') and not consent_endpoint:
+                current_app.logger.warning('not sending the consent cookie on a cacheable response (%s %s)',
+                                           request.method, request.path)
+                return
+            response.set_cookie(settings.cookie_name,
+                                self._state.extension.cookie_codec.encode(
+                                    self._state.extension.categories,
+                                    ConsentCookie(self._enabled, self._last_updated, self._decided)),
                                 secure=not current_app.debug and not current_app.testing,
                                 samesite='None',
-                                max_age=int(self._state.valid_for.days * 24 * 60 * 60))
+                                max_age=settings.max_age)
+            # only changes the visitor made (on the consent routes, directly or with a sync token) are audited, not
+            # stored consent being copied into the cookie or a view adjusting consent
+            if self._state.extension._audit_log is not None and consent_endpoint and not self._from_store:
+                self._record_audit_event()
+
+    def _record_audit_event(self):
+        user_id = self._user_id if self._user_id is not None else self._state.extension._user_loader()
+        self._state.extension._audit_log.record(AuditEvent(
+            timestamp=self._last_updated,
+            domain=request.host,
+            user_id=None if user_id is None else str(user_id),
+            enabled=frozenset(self._enabled)))
 
     @property
     def last_updated(self) -> datetime:
+        self._load()
         return self._last_updated
 
     @property
     def enabled(self) -> Set[str]:
+        self._load()
         return self._enabled
 
+    @property
+    def decisions(self) -> ConsentDecisions:
+        """
+        Whether each category is enabled, computed once and then reused until the consent is changed.
+
+        Cheaper than request.consent[category] when checking many times, for example in templates.
+        """
+        if self._decisions is None:
+            self._load()
+            enabled = self._enabled
+            self._decisions = ConsentDecisions({name: name in enabled for name in self._state.extension.categories})
+        return self._decisions
+
+    def replace(self, enabled: Iterable[str], last_updated: datetime = None, categories: Iterable[str] = None) -> bool:
+        """
+        Replace the set of enabled consent categories all at once
+
+        Giving the same consent again is a no-op (and doesn't send a Set-Cookie), unless the current consent is stale.
+
+        :param enabled: The names of the categories that should be enabled
+        :param last_updated: When the consent was given, if not now (for example when synchronizing from another domain)
+        :param categories: The names of the categories the user decided on, if not all of them. Categories outside of
+                           these keep their current value.
+        :return: True if anything changed
+        """
+        self._load()
+        if categories is None:
+            enabled = set(enabled)
+            decided = set(self._state.extension.categories)
+        else:
+            scope = set(categories)
+            enabled = (self._enabled - scope) | (set(enabled) & scope)
+            decided = self._decided | scope
+        if enabled == self._enabled and decided == self._decided and not self.is_stale():
+            return False
+        self._enabled = enabled
+        self._decided = decided
+        self._decisions = None
+        self._has_consent = True
+        self._dirty = True
+        self._from_store = False
+        self._last_updated = last_updated or _now()
+        return True
+
     def __getitem__(self, key: (ConsentCategory, str)) -> bool:
         """
         Lookup if the given consent category is enabled.
@@ -131,6 +598,7 @@ class ConsentData:
         """
         if isinstance(key, ConsentCategory):
             key = key.name
+        self._load()
         return key in self._enabled
 
     def __setitem__(self, key: (ConsentCategory, str), value: bool):
@@ -144,14 +612,54 @@ class ConsentData:
         """
         if isinstance(key, ConsentCategory):
             key = key.name
+        self._load()
         if value and key not in self._enabled:
             self._enabled.add(key)
-            self._dirty = True
-            self._last_updated = datetime.utcnow()
         elif not value and key in self._enabled:
             self._enabled.remove(key)
-            self._dirty = True
-            self._last_updated = datetime.utcnow()
+        elif key in self._decided:
+            return
+        self._decided.add(key)
+        self._decisions = None
+        self._has_consent = True
+        self._dirty = True
+        self._from_store = False
+        self._last_updated = _now()
+
+
+class DefaultConsentData(ConsentData):
+    __slots__ = ()
+
+    def __init__(self, state: ConsentExtensionState):
+        """
+        Read-only consent data containing the default for each category.
+
+        This is used as request.consent on endpoints exempt from the consent handling, the cookie is never read.
+        """
+        super().__init__(state)
+        self._loaded = True
+        self._enabled = frozenset(c.name for c in state.extension.categories.values() if c.default)
+        self._decided = frozenset()
+        self._last_updated = datetime.utcnow()
+
+    def is_stale(self):
+        return False
+
+    def is_partially_stale(self):
+        return False
+
+    @property
+    def undecided(self) -> Set[str]:
+        return set()
+
+    def finalize(self, response):
+        pass
+
+    def replace(self, enabled: Iterable[str], last_updated: datetime = None, categories: Iterable[str] = None) -> bool:
+        raise RuntimeError('consent can not be changed from an endpoint exempt from consent handling')
+
+    def __setitem__(self, key: (ConsentCategory, str), value: bool):
+        raise RuntimeError('consent can not be changed from an endpoint exempt from consent handling')
 
 
 class Consent:
@@ -172,8 +680,16 @@ class Consent:
         """
 
         self._categories = OrderedDict()
+        self._categories_version = 0
         self._domain_loader = lambda: []
         self._render_template_func = render_template
+        self._exempt_names = set()
+        self._exempt_predicates = []
+        self._exempt_version = 0
+        self._store = None  # type: Optional[ConsentStore]
+        self._user_loader = lambda: None
+        self._audit_log = None  # type: Optional[AuditLog]
+        self.cookie_codec = CompactCookieCodec()  # type: ConsentCookieCodec
 
         self.app = app
         if self.app:
@@ -182,21 +698,83 @@ class Consent:
     def domain_loader(self, func: Callable[[], Iterable[str]]):
         """
         Register the method that returns the list of valid domain names
+
+        The method may also be a coroutine function. Set CONSENT_DOMAINS_TTL to cache its result.
         """
         self._domain_loader = func
+        return func
+
+    def invalidate_domains(self):
+        """
+        Drops the cached list of domain names for the current app, for example after adding a new domain
+        """
+        self.state().domain_cache.invalidate()
 
     @property
     def domains(self) -> List[str]:
         """
         Returns the list of valid domain names
         """
-        result = list(self._domain_loader())
+        if has_request_context():
+            prefetched = getattr(request, '_flask_consent_domains', None)
+            if prefetched is not None:
+                return list(prefetched)
+        return self._with_debug_domain(list(self.state().domain_cache.get()))
+
+    def _request_domains(self) -> List[str]:
+        """The domains for the current request, the domain loader is called at most once per request."""
+        result = getattr(request, '_flask_consent_domains', None)
+        if result is None:
+            result = request._flask_consent_domains = self._with_debug_domain(list(self.state().domain_cache.get()))
+        return list(result)
+
+    async def domains_async(self) -> List[str]:
+        """
+        Returns the list of valid domain names without blocking the event loop, for use in async views
+
+        The result is remembered for the rest of the request, so rendering the consent code afterwards doesn't call the
+        domain loader again.
+        """
+        result = self._with_debug_domain(list(await self.state().domain_cache.get_async()))
+        if has_request_context():
+            request._flask_consent_domains = result
+        return list(result)
+
+    @staticmethod
+    def _with_debug_domain(result: List[str]) -> List[str]:
         if current_app.debug:
             host_domain = request.headers['Host'].split('/')[-1].split(':')[0]
             if host_domain == 'localhost':
                 result.append(request.headers['Host'])
         return result
 
+    def exempt(self, target):
+        """
+        Exempt a view function, blueprint or endpoint name from the consent handling.
+
+        Can be used as a decorator on view functions. On exempt endpoints request.consent contains the defaults and
+        the consent cookie is neither read nor written. Endpoints, blueprints and URL prefixes can also be exempted
+        using the CONSENT_EXEMPT configuration option.
+        """
+        if isinstance(target, Blueprint):
+            self._exempt_names.add(target.name)
+        elif isinstance(target, str):
+            self._exempt_names.add(target)
+        else:
+            target._flask_consent_exempt = True
+        self._exempt_version += 1
+        return target
+
+    def exempt_when(self, predicate: Callable[[str], bool]):
+        """
+        Register a function that is given an endpoint name and returns True if it should be exempt
+
+        The function is only called once per endpoint.
+        """
+        self._exempt_predicates.append(predicate)
+        self._exempt_version += 1
+        return predicate
+
     def set_render_template_func(self, f):
         """
         Overrides the template rendering function used (normally flask.render_template).
@@ -205,6 +783,39 @@ class Consent:
         """
         self._render_template_func = f
 
+    def set_cookie_codec(self, codec: ConsentCookieCodec):
+        """
+        Overrides the codec used to read and write the consent cookie (normally CompactCookieCodec).
+
+        Use JsonCookieCodec to keep writing the original JSON format.
+        """
+        self.cookie_codec = codec
+
+    def set_store(self, store: Optional[ConsentStore]):
+        """
+        Keep the consent of authenticated users in a server side store (see flask_consent.store)
+
+        Consent from the store is used if it's newer than the cookie on the current domain, and changes are written
+        back to it. Requires a user loader to be registered.
+        """
+        self._store = store
+
+    def set_audit_log(self, audit_log: Optional[AuditLog]):
+        """
+        Record every change of consent in an audit log (see flask_consent.audit)
+
+        Events are queued in memory and written to the log's sink in batches by a background thread, so this doesn't
+        add any I/O to the request. The user id is taken from the user loader, if one is registered.
+        """
+        self._audit_log = audit_log
+
+    def user_loader(self, func: Callable[[], Optional[Hashable]]):
+        """
+        Register the method that returns the id of the current user, or None if not authenticated
+        """
+        self._user_loader = func
+        return func
+
     def init_app(self, app: Flask):
         app.config.setdefault('CONSENT_FULL_TEMPLATE', None)
         app.config.setdefault('CONSENT_BANNER_TEMPLATE', None)
@@ -213,21 +824,44 @@ class Consent:
         app.config.setdefault('CONSENT_VALID_FOR_MONTHS', 12)
         app.config.setdefault('CONSENT_PRIMARY_SERVERNAME', app.config.get('SERVER_NAME', None))
         app.config.setdefault('CONSENT_PATH', '/consent')
+        app.config.setdefault('CONSENT_CACHE_BANNER', True)
+        app.config.setdefault('CONSENT_CACHE_FULL_PAGE', False)
+        app.config.setdefault('CONSENT_DOMAINS_TTL', 0)
+        app.config.setdefault('CONSENT_DOMAINS_STALE_TTL', 60)
+        app.config.setdefault('CONSENT_CORS_MAX_AGE', 86400)
+        app.config.setdefault('CONSENT_CACHEABLE', False)
+        app.config.setdefault('CONSENT_METRICS', True)
+        app.config.setdefault('CONSENT_EXEMPT', ['static', 'flask_consent_script'])
+        app.config.setdefault('CONSENT_SYNC_MODE', 'xhr')
+        app.config.setdefault('CONSENT_SYNC_TOKEN_MAX_AGE', 60)
+        app.config.setdefault('CONSENT_ASYNC', False)
 
         if 'consent' in app.extensions:
             raise KeyError('It seems you have already registered this extension on this app')
-        app.extensions['consent'] = ConsentExtensionState(self, app)
+        state = app.extensions['consent'] = ConsentExtensionState(self, app)
+
+        if app.config['CONSENT_ASYNC']:
+            consent_route, sync_route = self._handle_consent_route_async, self._handle_sync_route_async
+        else:
+            consent_route, sync_route = self._handle_consent_route, self._handle_sync_route
+        app.add_url_rule(app.config['CONSENT_PATH'], 'flask_consent', consent_route, methods=('GET', 'POST', 'OPTIONS'))
+        app.add_url_rule(app.config['CONSENT_PATH'] + '/consent.<version>.js', 'flask_consent_script',
+                         self._handle_script_route)
+        app.add_url_rule(app.config['CONSENT_PATH'] + '/sync', 'flask_consent_sync', sync_route)
+        app.cli.add_command(consent_cli)
 
-        app.add_url_rule(app.config['CONSENT_PATH'], 'flask_consent',
-                         self._handle_consent_route, methods=('GET', 'POST'))
+        template_context = dict(flask_consent_code=state.html, consent=LocalProxy(_current_decisions))
 
         @app.context_processor
         def context_processor():
-            return dict(flask_consent_code=self.state().html)
+            return template_context
 
         @app.before_request
         def prepare_request():
-            request.consent = ConsentData(self.state())
+            if state.is_exempt(request.endpoint):
+                request.consent = state.default_consent
+            else:
+                request.consent = ConsentData(state)
 
         @app.after_request
         def finalize_request(response):
@@ -238,8 +872,40 @@ class Consent:
     def state(cls) -> ConsentExtensionState:
         return current_app.extensions['consent']
 
+    def reload_settings(self, app: Flask = None):
+        """
+        Re-reads the CONSENT_* configuration options
+
+        The configuration is read once when the extension is initialized, call this if you change it at runtime.
+        """
+        state = app.extensions['consent'] if app else self.state()
+        state.reload_settings()
+
+    def warmup(self, app: Flask = None) -> Dict[str, Optional[float]]:
+        """
+        Loads and compiles the templates and the script, and the domain list if it is cached, ahead of the first request
+
+        Call this in every worker process before it accepts requests, for example from gunicorn's post_fork hook.
+        Returns the seconds each step took.
+        """
+        state = app.extensions['consent'] if app else self.state()
+        base_url = 'http://{}/'.format(state.settings.primary_servername or 'localhost')
+        with state.app.test_request_context(base_url=base_url):
+            return state.warmup()
+
+    @property
+    def metrics(self) -> MetricsRegistry:
+        """The metrics registry for the current app"""
+        return self.state().metrics
+
+    def export_metrics(self) -> str:
+        """
+        Returns the metrics for the current app in the Prometheus text format, for use in your metrics endpoint
+        """
+        return render_prometheus(self.metrics)
+
     def add_category(self, name: str, title: str, description: str,
-                     default: bool, is_required: bool = False) -> ConsentCategory:
+                     default: bool, is_required: bool = False, index: int = None) -> ConsentCategory:
         """
         Register a new category of consent
         :param name: A name used to identify the category (e.g. preferences, analytics)
@@ -247,9 +913,22 @@ class Consent:
         :param description: A human readable description on what these cookies are used for
         :param default: The default value (pre-checked or not)
         :param is_required: Whether allowing this category is required for the site to function or not
+        :param index: The position of this category in the consent cookie. Defaults to the next free index, pass it
+                      explicitly if you ever remove or reorder categories so existing cookies keep their meaning.
         :return:
         """
-        self._categories[name] = ConsentCategory(name, title, description, default, is_required)
+        if hasattr(ConsentDecisions, name):
+            # the decisions are attributes of ConsentDecisions, a category like "get" would hide Mapping.get
+            raise ValueError('{!r} can not be used as the name of a consent category'.format(name))
+        if index is None:
+            if name in self._categories:
+                index = self._categories[name].index
+            else:
+                index = max((c.index + 1 for c in self._categories.values()), default=0)
+        elif any(c.index == index and c.name != name for c in self._categories.values()):
+            raise ValueError('consent category index {} is already in use'.format(index))
+        self._categories[name] = ConsentCategory(name, title, description, default, is_required, index)
+        self._categories_version += 1
         return self._categories[name]
 
     def add_standard_categories(self):
@@ -279,29 +958,248 @@ class Consent:
     def categories(self) -> OrderedDict:
         return self._categories
 
+    def _handle_script_route(self, version):
+        source, current_version = self.state().script
+        response = current_app.response_class(source, mimetype='application/javascript')
+        response.set_etag(current_version)
+        if version == current_version:
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            # a page rendered before a deploy may still refer to an old version, serve it but don't cache it for long
+            response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
+    def _is_allowed_host(self, netloc: str) -> bool:
+        netloc = netloc.lower()
+        allowed = set(self._request_domains())
+        allowed.add(request.host)
+        settings = self.state().settings
+        if settings.primary_servername:
+            allowed.add(settings.primary_servername)
+            allowed.add(settings.primary_domain)
+        return netloc in allowed or netloc.rsplit(':', 1)[0] in allowed
+
+    def _allowed_origin(self) -> Optional[str]:
+        origin = request.headers.get('Origin')
+        if not origin:
+            return None
+        if self._is_allowed_host(urlsplit(origin).netloc):
+            return origin
+        return None
+
+    def _add_cors_headers(self, response: Response) -> Response:
+        origin = self._allowed_origin()
+        if origin:
+            response.headers['Access-Control-Allow-Origin'] = origin
+        response.headers['Access-Control-Allow-Credentials'] = 'true'
+        response.vary.add('Origin')
+        return response
+
+    def _record_request(self, outcome: str):
+        self.state().metrics.inc('requests_total', method=request.method, outcome=outcome)
+        consent_requested.send(current_app._get_current_object(), method=request.method, outcome=outcome)
+
+    def _apply_sync_token(self, token) -> bool:
+        tokens = self.state().sync_tokens
+        synced = tokens.loads(token) if tokens and isinstance(token, str) else None
+        if synced is None:
+            return False
+        enabled, last_updated = synced
+        # a token only fills in missing consent, so one planted through a link can't override the visitor's choice
+        if request.consent.is_stale():
+            request.consent.replace((c for c in enabled if c in self._categories), last_updated)
+        return True
+
+    async def _handle_sync_route_async(self):
+        await self.domains_async()
+        return self._handle_sync_route()
+
+    def _handle_sync_route(self):
+        """
+        Redirect based synchronization, used instead of XHR requests when CONSENT_SYNC_MODE is redirect.
+
+        A domain without consent sends the browser to this route with the page to return to in the next parameter.
+        It remembers a random nonce in a cookie and redirects to this route on the primary domain, with the page in
+        the return parameter. The primary domain redirects back to this route on the original domain with the nonce
+        and a signed token of its consent (if any), which is applied if the nonce matches the cookie, and finally
+        redirects back to the page.
+        """
+        settings = self.state().settings
+        if self.state().sync_tokens is None:
+            abort(404)
+        nonce_cookie = settings.cookie_name + '_sync'
+
+        if 'return' in request.args:
+            target = urlsplit(request.args['return'])
+            if target.scheme not in ('http', 'https') or not self._is_allowed_host(target.netloc):
+                self._record_request('invalid_return')
+                abort(400)
+            query = dict(next=urlunsplit(('', '', target.path or '/', target.query, '')))
+            nonce = request.args.get('nonce')
+            if nonce:
+                query['nonce'] = nonce
+                if not request.consent.is_stale():
+                    query['token'] = self.state().sync_tokens.dumps(request.consent.enabled,
+                                                                    request.consent.last_updated)
+            self._record_request('sync_redirect')
+            return redirect(urlunsplit((target.scheme, target.netloc, url_for('flask_consent_sync'),
+                                        urlencode(query), '')))
+
+        next_url = _local_url(request.args.get('next', '/'))
+        if 'nonce' not in request.args and 'token' not in request.args:
+            # start of the round trip
+            nonce = secrets.token_urlsafe(16)
+            page = request.host_url[:-1] + next_url
+            response = redirect(urlunsplit((request.scheme, settings.primary_servername, url_for('flask_consent_sync'),
+                                            urlencode([('return', page), ('nonce', nonce)]), '')))
+            response.set_cookie(nonce_cookie, nonce, max_age=settings.sync_token_max_age, httponly=True,
+                                secure=not current_app.debug and not current_app.testing, samesite='Lax')
+            return response
+
+        expected = request.cookies.get(nonce_cookie)
+        nonce_valid = bool(expected) and hmac.compare_digest(expected, request.args.get('nonce', ''))
+        if 'token' in request.args:
+            applied = nonce_valid and self._apply_sync_token(request.args['token'])
+            self._record_request('synced' if applied else 'invalid_token')
+        response = redirect(next_url)
+        response.delete_cookie(nonce_cookie)
+        return response
+
+    def _conditional(self, tag: str, outcome: str, build: Callable) -> Response:
+        """Answers with 304 if the client already has the response tagged with tag, otherwise builds it."""
+        if tag in request.if_none_match:
+            self._record_request('not_modified')
+            response = current_app.response_class(status=304)
+        else:
+            self._record_request(outcome)
+            response = current_app.make_response(build())
+        response.set_etag(tag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return self._add_cors_headers(response)
+
+    async def _handle_consent_route_async(self):
+        """The consent route as an async view, looking up the domains (needed for CORS) without blocking."""
+        await self.domains_async()
+        return self._handle_consent_route()
+
     def _handle_consent_route(self):
+        if request.method == 'OPTIONS':
+            # CORS preflight, answered without looking at the consent cookie
+            response = current_app.response_class(status=204)
+            response.headers['Access-Control-Allow-Methods'] = 'GET, POST'
+            response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+            response.headers['Access-Control-Max-Age'] = self.state().settings.cors_max_age
+            self._record_request('preflight')
+            return self._add_cors_headers(response)
+
         if request.content_type == 'application/json':
-            def respond(status_code, **kwargs):
+            def build(status_code, **kwargs):
                 response: Response = jsonify(**kwargs)
                 response.status_code = status_code
-                response.headers['Access-Control-Allow-Credentials'] = 'true'
                 return response
 
+            def respond(status_code, **kwargs):
+                return self._add_cors_headers(build(status_code, **kwargs))
+
             if request.method == 'POST':
                 new = request.json
-                if not isinstance(new, list):
+                if isinstance(new, dict) and 'token' in new:
+                    if not self._apply_sync_token(new['token']):
+                        self._record_request('invalid_token')
+                        return respond(400, msg='invalid sync token')
+                    self._record_request('synced')
+                    return respond(200,
+                                   enabled=list(request.consent.enabled),
+                                   last_updated=request.consent.last_updated.isoformat())
+                scope = None
+                if isinstance(new, dict) and 'enabled' in new:
+                    # a decision about only some of the categories, as sent by a partial banner
+                    new, scope = new['enabled'], new.get('categories')
+                if not isinstance(new, list) or not isinstance(scope, (list, type(None))):
+                    self._record_request('invalid_payload')
                     return respond(400, msg='payload is not a list')
-                for cat in new:
-                    if cat not in self._categories:
-                        return respond(400, msg='invalid consent category specified: ' + cat)
-                for cat in self._categories.keys():
-                    request.consent[cat] = cat in new
+                for cat in new + (scope or []):
+                    if not isinstance(cat, str) or cat not in self._categories:
+                        self._record_request('invalid_category')
+                        return respond(400, msg='invalid consent category specified: ' + str(cat))
+                if not request.consent.replace(new, categories=scope):
+                    # nothing to tell the client, it already has this consent
+                    self._record_request('unchanged')
+                    return self._add_cors_headers(current_app.response_class(status=204))
+                self._record_request('updated')
+            else:
+                consent = request.consent
+                stale = consent.is_stale()
+                tokens = self.state().sync_tokens
+                if tokens and not stale:
+                    # tokens are short-lived, so these responses must not be reused
+                    self._record_request('ok')
+                    response = respond(200,
+                                       enabled=list(consent.enabled),
+                                       last_updated=consent.last_updated.isoformat(),
+                                       stale=False,
+                                       token=tokens.dumps(consent.enabled, consent.last_updated))
+                    response.cache_control.no_store = True
+                    return response
+                key = ('json', tuple(sorted(consent.enabled)), None if stale else consent.last_updated.isoformat())
+                # _conditional adds the CORS headers
+                return self._conditional(_etag(key), 'ok', lambda: build(
+                    200, enabled=list(consent.enabled), last_updated=consent.last_updated.isoformat(), stale=stale))
             return respond(200,
                            enabled=list(request.consent.enabled),
                            last_updated=request.consent.last_updated.isoformat())
         else:
-            return self._render_template_func(
-                self.state().full_template,
-                flask_consent_categories=self._categories.values(),
-                flask_consent_contact_mail=self.state().contact_mail
-            )
+            state = self.state()
+            if not state.settings.cache_full_page:
+                self._record_request('page')
+                return self._render_template_func(
+                    state.full_template,
+                    flask_consent_categories=self._categories.values(),
+                    flask_consent_contact_mail=state.contact_mail
+                )
+            key = state.page_key(request.consent)
+            return self._conditional(_etag(key), 'page', lambda: state.full_page(key))
+
+
+def _current_decisions() -> ConsentDecisions:
+    return request.consent.decisions
+
+
+def consent_required(category: (ConsentCategory, str), fallback: Callable = None):
+    """
+    A view decorator that only calls the view if the given category is enabled
+
+    :param category: The consent category, either as a ConsentCategory object or the name as a string
+    :param fallback: Called with the view arguments instead of the view if consent is missing. Defaults to aborting
+                     with 403 Forbidden.
+    """
+    name = category.name if isinstance(category, ConsentCategory) else category
+
+    def decorator(view):
+        def denied(*args, **kwargs):
+            if fallback is None:
+                abort(403)
+            return fallback(*args, **kwargs)
+
+        if inspect.iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(*args, **kwargs):
+                decisions = request.consent.decisions
+                if not (name in decisions and decisions[name]):
+                    result = denied(*args, **kwargs)
+                    return await result if inspect.isawaitable(result) else result
+                return await view(*args, **kwargs)
+
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            decisions = request.consent.decisions
+            if not (name in decisions and decisions[name]):
+                return denied(*args, **kwargs)
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+"""Aggregation of consent cookies found in access logs, used by the ``flask consent analyze`` command."""
+
+import csv
+import gzip
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import IO, Iterable, Iterator, Mapping, Optional, Pattern, Tuple
+
+from werkzeug.http import parse_cookie
+
+from .codec import ConsentCookie, ConsentCookieCodec
+
+#: upper bounds (in days) of the staleness histogram buckets, the last bucket is open ended
+STALENESS_BUCKETS = (30, 90, 180, 365, 730)
+
+
+def staleness_bucket(age: timedelta) -> str:
+    days = age.days
+    lower = 0
+    for upper in STALENESS_BUCKETS:
+        if days < upper:
+            return '{}-{}'.format(lower, upper)
+        lower = upper
+    return '{}+'.format(lower)
+
+
+class ConsentAggregate:
+    def __init__(self, now: datetime, valid_for: timedelta):
+        """
+        Counts of decoded consent cookies, per category, domain and month in which consent was given.
+
+        Memory use depends on the number of categories, domains and months seen, not on the number of cookies.
+        Aggregates from different processes are combined with merge().
+        """
+        self.now = now
+        self.valid_for = valid_for
+        self.total = 0
+        self.invalid = 0
+        self.expired = 0
+        self.categories = Counter()  # type: Counter
+        self.domains = {}  # type: dict
+        self.months = {}  # type: dict
+        self.staleness = Counter()  # type: Counter
+
+    def add(self, domain: str, cookie: ConsentCookie):
+        # everything that can fail is computed before counting, so a bad cookie doesn't leave partial counts behind
+        try:
+            enabled = frozenset(cookie.enabled)
+            if not all(isinstance(name, str) for name in enabled):
+                raise TypeError('category names need to be strings')
+            if cookie.last_updated is not None:
+                month = cookie.last_updated.strftime('%Y-%m')
+                age = self.now - cookie.last_updated
+        except (TypeError, ValueError):
+            self.invalid += 1
+            return
+        self.total += 1
+        self.categories.update(enabled)
+        self._count(self.domains, domain, enabled)
+        if cookie.last_updated is None:
+            self._count(self.months, 'unknown', enabled)
+            self.staleness['unknown'] += 1
+        else:
+            self._count(self.months, month, enabled)
+            self.staleness[staleness_bucket(age)] += 1
+            if age > self.valid_for:
+                self.expired += 1
+
+    @staticmethod
+    def _count(groups: dict, key: str, enabled: Iterable[str]):
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = Counter()
+        group['_total'] += 1
+        group.update(enabled)
+
+    def merge(self, other: 'ConsentAggregate'):
+        self.total += other.total
+        self.invalid += other.invalid
+        self.expired += other.expired
+        self.categories.update(other.categories)
+        self.staleness.update(other.staleness)
+        for mine, theirs in ((self.domains, other.domains), (self.months, other.months)):
+            for key, counts in theirs.items():
+                mine.setdefault(key, Counter()).update(counts)
+
+    def to_dict(self) -> dict:
+        def group(counts: Counter) -> dict:
+            return dict(total=counts['_total'], categories={k: v for k, v in sorted(counts.items()) if k != '_total'})
+
+        return dict(total=self.total, invalid=self.invalid, expired=self.expired,
+                    categories=dict(sorted(self.categories.items())),
+                    domains={k: group(v) for k, v in sorted(self.domains.items())},
+                    months={k: group(v) for k, v in sorted(self.months.items())},
+                    staleness={bucket: self.staleness[bucket] for bucket in self._buckets()})
+
+    def write_csv(self, out: IO):
+        """Writes one row per count, with the columns dimension, key, category and count."""
+        writer = csv.writer(out)
+        writer.writerow(('dimension', 'key', 'category', 'count'))
+        for name in ('total', 'invalid', 'expired'):
+            writer.writerow((name, '', '', getattr(self, name)))
+        for category, count in sorted(self.categories.items()):
+            writer.writerow(('category', '', category, count))
+        for dimension, groups in (('domain', self.domains), ('month', self.months)):
+            for key, counts in sorted(groups.items()):
+                writer.writerow((dimension, key, '', counts['_total']))
+                for category, count in sorted(counts.items()):
+                    if category != '_total':
+                        writer.writerow((dimension, key, category, count))
+        for bucket in self._buckets():
+            writer.writerow(('staleness', bucket, '', self.staleness[bucket]))
+
+    def _buckets(self):
+        buckets = [staleness_bucket(timedelta(days=days)) for days in (0,) + STALENESS_BUCKETS]
+        if self.staleness['unknown']:
+            buckets.append('unknown')
+        return buckets
+
+
+def read_lines(path: str) -> Iterator[str]:
+    """Yields the lines of a log file, transparently decompressing files ending in .gz."""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+        yield from f
+
+
+def cookie_pattern(cookie_name: str) -> Pattern:
+    """Matches the consent cookie in a Cookie header, both quoted (as set by Werkzeug) and unquoted."""
+    return re.compile(r'(?:^|[\s;"]){}=("(?:[^"\\]|\\.)*"|[^;\s"]*)'.format(re.escape(cookie_name)))
+
+
+def extract(lines: Iterable[str], cookie_name: str, domain_pattern: Optional[Pattern]) -> Iterator[Tuple[str, str]]:
+    """Yields the domain and the consent cookie value of all lines that contain one."""
+    pattern = cookie_pattern(cookie_name)
+    for line in lines:
+        match = pattern.search(line)
+        if match is None:
+            continue
+        value = match.group(1)
+        if value.startswith('"'):
+            value = parse_cookie('{}={}'.format(cookie_name, value)).get(cookie_name, '')
+        domain = ''
+        if domain_pattern is not None:
+            domain_match = domain_pattern.search(line)
+            if domain_match is not None:
+                domain = domain_match.group(1)
+        yield domain, value
+
+
+def decode(values: Iterable[Tuple[str, str]], codec: ConsentCookieCodec,
+           categories: Mapping) -> Iterator[Tuple[str, ConsentCookie]]:
+    """Decodes cookie values with the same codec and categories that ConsentData uses."""
+    for domain, value in values:
+        try:
+            cookie = codec.decode(categories, value)
+        except (TypeError, ValueError):
+            # counted as invalid, like values the codec rejects itself
+            cookie = ConsentCookie()
+        yield domain, cookie
+
+
+def analyze_file(path: str, codec: ConsentCookieCodec, categories: Mapping, cookie_name: str,
+                 domain_regex: Optional[str], now: datetime, valid_for: timedelta) -> ConsentAggregate:
+    domain_pattern = re.compile(domain_regex) if domain_regex else None
+    aggregate = ConsentAggregate(now, valid_for)
+    for domain, cookie in decode(extract(read_lines(path), cookie_name, domain_pattern), codec, categories):
+        aggregate.add(domain, cookie)
+    return aggregate
+
+
+def analyze(paths: Iterable[str], codec: ConsentCookieCodec, categories: Mapping, cookie_name: str,
+            valid_for: timedelta, domain_regex: str = None, jobs: int = 1, now: datetime = None) -> ConsentAggregate:
+    """
+    Analyzes log files, each file in its own worker process if jobs is more than one.
+
+    The codec and categories need to be picklable when using several processes.
+    """
+    now = now or datetime.utcnow()
+    result = ConsentAggregate(now, valid_for)
+    args = (codec, dict(categories), cookie_name, domain_regex, now, valid_for)
+    if jobs <= 1:
+        for path in paths:
+            result.merge(analyze_file(path, *args))
+        return result
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = [executor.submit(analyze_file, path, *args) for path in paths]
+        for future in futures:
+            result.merge(future.result())
+    return result
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+"""A write-behind audit log of consent changes."""
+
+import atexit
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import FrozenSet, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# put on the queue to wake the worker up, to write the batch it is collecting right away or to stop
+_FLUSH = object()
+_STOP = object()
+
+
+@dataclass(frozen=True)
+class AuditEvent:
+    """A single change of consent."""
+
+    timestamp: datetime
+    domain: str
+    user_id: Optional[str]
+    enabled: FrozenSet[str]
+
+    def to_dict(self) -> dict:
+        return dict(timestamp=self.timestamp.isoformat(), domain=self.domain, user_id=self.user_id,
+                    enabled=sorted(self.enabled))
+
+
+class AuditSink:
+    """Base class for audit sinks, receiving batches of events from the background worker."""
+
+    def write(self, events: List[AuditEvent]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteAuditSink(AuditSink):
+    def __init__(self, path: str, table: str = 'flask_consent_audit'):
+        """Writes events to a SQLite table, one transaction per batch."""
+        self.table = table
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS {} (timestamp TEXT NOT NULL, domain TEXT NOT NULL, user_id TEXT, '
+                'enabled TEXT NOT NULL)'.format(self.table))
+
+    def write(self, events: List[AuditEvent]):
+        with self._connection:
+            self._connection.executemany(
+                'INSERT INTO {} (timestamp, domain, user_id, enabled) VALUES (?, ?, ?, ?)'.format(self.table),
+                [(e.timestamp.isoformat(), e.domain, e.user_id, json.dumps(sorted(e.enabled))) for e in events])
+
+    def close(self):
+        self._connection.close()
+
+
+class JsonLinesAuditSink(AuditSink):
+    def __init__(self, path: str):
+        """Appends events to a file, one JSON object per line."""
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, events: List[AuditEvent]):
+        self._file.write(''.join(json.dumps(e.to_dict()) + '\n' for e in events))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class AuditLog:
+    DROP_NEW = 'drop_new'
+    DROP_OLDEST = 'drop_oldest'
+    BLOCK = 'block'
+
+    def __init__(self, sink: AuditSink, maxsize: int = 10000, batch_size: int = 100, flush_interval: float = 1.0,
+                 policy: str = DROP_NEW, block_timeout: float = 1.0):
+        """
+        Queues audit events in memory and writes them to the sink in batches from a background thread.
+
+        When the queue is full the policy decides what happens: DROP_NEW discards the new event, DROP_OLDEST
+        discards the oldest queued event and BLOCK waits up to block_timeout seconds for room before dropping the
+        new event. Dropped events are counted in `dropped`, events the sink failed to write in `failed`.
+
+        A batch is written once it has batch_size events, or flush_interval seconds after its first event was
+        queued, whichever comes first. The sink is only used from the worker thread, which is started on the first
+        event (so it's safe to create the log before forking). Remaining events are written when the interpreter
+        exits, or when close() is called.
+        """
+        if policy not in (self.DROP_NEW, self.DROP_OLDEST, self.BLOCK):
+            raise ValueError('invalid audit log policy: {}'.format(policy))
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.recorded = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+        self._closed = False
+        atexit.register(self.close)
+
+    def record(self, event: AuditEvent) -> bool:
+        """Queues an event, returns False if it had to be dropped."""
+        if self._closed:
+            # requests can still be finishing while the app shuts down (the log is closed at exit)
+            self._count('dropped')
+            return False
+        self._ensure_worker()
+        try:
+            if self.policy == self.BLOCK:
+                self._queue.put(event, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(event)
+        except queue.Full:
+            if self.policy != self.DROP_OLDEST:
+                self._count('dropped')
+                return False
+            try:
+                self._queue.get_nowait()
+                self._queue.task_done()
+                self._count('dropped')
+            except queue.Empty:
+                pass
+            try:
+                self._queue.put_nowait(event)
+            except queue.Full:
+                self._count('dropped')
+                return False
+        self._count('recorded')
+        return True
+
+    def flush(self):
+        """Blocks until all queued events have been handed to the sink, without waiting for the batch to fill."""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(_FLUSH)
+            self._queue.join()
+
+    def close(self, timeout: float = 10.0):
+        """Writes the remaining events and closes the sink, waiting up to timeout seconds for the worker."""
+        if self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+        if self._thread is None:
+            self.sink.close()
+            return
+        try:
+            self._queue.put_nowait(_STOP)
+        except queue.Full:
+            pass  # the worker is busy and will notice that it should stop after the current batch
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            # sinks aren't thread-safe, the worker writes the rest and closes the sink when it gets to it
+            logger.warning('the consent audit log is still writing after %s seconds', timeout)
+
+    def _count(self, counter: str, amount: int = 1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def _ensure_worker(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='flask-consent-audit', daemon=True)
+                self._thread.start()
+
+    def _drain(self, limit: int) -> List[AuditEvent]:
+        events = []
+        while len(events) < limit:
+            try:
+                event = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if event is _STOP or event is _FLUSH:
+                self._queue.task_done()
+            else:
+                events.append(event)
+        return events
+
+    def _next_batch(self) -> List[AuditEvent]:
+        """Waits for an event and collects more until the batch is full, flush_interval passed or flush() is called."""
+        try:
+            # the timeout is only there to notice that the log was closed while the queue was full
+            event = self._queue.get(timeout=self.flush_interval)
+        except queue.Empty:
+            return []
+        events = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            if event is _STOP or event is _FLUSH:
+                self._queue.task_done()
+                break
+            events.append(event)
+            remaining = deadline - time.monotonic()
+            if len(events) >= self.batch_size or remaining <= 0:
+                break
+            try:
+                event = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+        return events
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._write_batch(self._next_batch())
+        while True:
+            events = self._drain(self.batch_size)
+            if not events:
+                break
+            self._write_batch(events)
+        self.sink.close()
+
+    def _write_batch(self, events: List[AuditEvent]):
+        if not events:
+            return
+        try:
+            self.sink.write(events)
+            self._count('written', len(events))
+        except Exception:
+            logger.exception('could not write %d consent audit events', len(events))
+            self._count('failed', len(events))
+        finally:
+            for _ in events:
+                self._queue.task_done()
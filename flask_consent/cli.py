@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+"""The ``flask consent`` command group, registered on the app by Consent.init_app."""
+
+import json
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from .analyze import analyze
+
+consent_cli = AppGroup('consent', help='Consent management commands.')
+
+
+@consent_cli.command('analyze')
+@click.argument('logs', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'output_format', type=click.Choice(['json', 'csv']), default='json', show_default=True)
+@click.option('--output', type=click.File('w'), default='-', help='Where to write the result, default stdout.')
+@click.option('--domain-regex', default=None,
+              help='A regular expression whose first group extracts the domain from a log line.')
+@click.option('--jobs', type=int, default=1, show_default=True, help='Number of worker processes, one file each.')
+def analyze_command(logs, output_format, output, domain_regex, jobs):
+    """Aggregates the consent cookies found in access logs (optionally gzipped)."""
+    state = current_app.extensions['consent']
+    result = analyze(logs, state.extension.cookie_codec, state.extension.categories, state.settings.cookie_name,
+                     state.settings.valid_for, domain_regex=domain_regex, jobs=jobs)
+    if output_format == 'csv':
+        result.write_csv(output)
+    else:
+        json.dump(result.to_dict(), output, indent=2)
+        output.write('\n')
+
+
+@consent_cli.command('warmup')
+def warmup_command():
+    """Runs the warmup steps and shows how long each of them took."""
+    state = current_app.extensions['consent']
+    for step, seconds in state.extension.warmup(current_app).items():
+        click.echo('{:<20} {}'.format(step, 'failed' if seconds is None else '{:.2f} ms'.format(seconds * 1e3)))
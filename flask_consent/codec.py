@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+"""Encoding and decoding of the consent cookie."""
+
+import json
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Iterable, Mapping, Optional, Set
+
+EPOCH = datetime(1970, 1, 1)
+
+
+@dataclass
+class ConsentCookie:
+    """
+    The decoded contents of a consent cookie. Fields are None if they were missing or invalid.
+
+    decided holds the categories the user has made a choice about, it is None for cookies written before this was
+    recorded (which are taken to cover all categories).
+    """
+
+    enabled: Optional[Set[str]] = None
+    last_updated: Optional[datetime] = None
+    decided: Optional[Set[str]] = None
+
+
+class ConsentCookieCodec:
+    """
+    Base class for cookie codecs.
+
+    The categories passed to both methods is the mapping of category name to ConsentCategory from Consent.categories.
+    """
+
+    def encode(self, categories: Mapping, cookie: ConsentCookie) -> str:
+        raise NotImplementedError
+
+    def decode(self, categories: Mapping, value: str) -> ConsentCookie:
+        raise NotImplementedError
+
+
+class JsonCookieCodec(ConsentCookieCodec):
+    """The original cookie format, a JSON object with a list of category names and an ISO timestamp."""
+
+    def encode(self, categories: Mapping, cookie: ConsentCookie) -> str:
+        data = dict(enabled=list(cookie.enabled), last_updated=cookie.last_updated.isoformat())
+        if cookie.decided is not None:
+            data['decided'] = list(cookie.decided)
+        return json.dumps(data)
+
+    def decode(self, categories: Mapping, value: str) -> ConsentCookie:
+        try:
+            data = json.loads(value)
+        except ValueError:
+            return ConsentCookie()
+        if not isinstance(data, dict):
+            return ConsentCookie()
+
+        enabled, decided = data.get('enabled'), data.get('decided')
+        if isinstance(enabled, list) and not all(isinstance(e, str) for e in enabled):
+            return ConsentCookie()
+
+        result = ConsentCookie()
+        try:
+            result.last_updated = datetime.fromisoformat(data['last_updated'])
+        except (ValueError, KeyError, TypeError):
+            pass
+        if result.last_updated is not None and result.last_updated.tzinfo is not None:
+            # the extension only writes naive UTC timestamps, anything else wasn't written by us
+            return ConsentCookie()
+        if 'enabled' in data:
+            result.enabled = set(enabled) if isinstance(enabled, list) else set()
+        if isinstance(decided, list) and all(isinstance(d, str) for d in decided):
+            result.decided = set(decided)
+        return result
+
+
+class CompactCookieCodec(ConsentCookieCodec):
+    """
+    A short, URL-safe cookie format: ``<version>.<enabled bitmask>.<epoch seconds>.<decided bitmask>``, numbers in hex.
+
+    Bits in the masks correspond to ConsentCategory.index, so category indices need to stay stable between releases.
+    Cookies in the JSON format and in the first version of this format (without the decided mask) are still decoded,
+    so users that gave consent before switching aren't asked again.
+    """
+
+    VERSION = '2'
+
+    def __init__(self, fallback: ConsentCookieCodec = None):
+        self.fallback = fallback or JsonCookieCodec()
+
+    @staticmethod
+    def _mask(categories: Mapping, names: Iterable[str]) -> int:
+        mask = 0
+        for name in names:
+            category = categories.get(name)
+            if category is not None:
+                mask |= 1 << category.index
+        return mask
+
+    def encode(self, categories: Mapping, cookie: ConsentCookie) -> str:
+        mask = self._mask(categories, cookie.enabled)
+        epoch = int((cookie.last_updated - EPOCH).total_seconds())
+        if cookie.decided is None:
+            return '1.{:x}.{:x}'.format(mask, epoch)
+        return '{}.{:x}.{:x}.{:x}'.format(self.VERSION, mask, epoch, self._mask(categories, cookie.decided))
+
+    def decode(self, categories: Mapping, value: str) -> ConsentCookie:
+        if value.startswith('{'):
+            return self.fallback.decode(categories, value)
+
+        parts = value.split('.')
+        if (parts[0], len(parts)) not in (('1', 3), (self.VERSION, 4)):
+            return ConsentCookie()
+        try:
+            mask, epoch, *decided = (int(part, 16) for part in parts[1:])
+        except ValueError:
+            return ConsentCookie()
+
+        result = ConsentCookie(enabled={c.name for c in categories.values() if mask & (1 << c.index)})
+        if decided:
+            result.decided = {c.name for c in categories.values() if decided[0] & (1 << c.index)}
+        try:
+            result.last_updated = EPOCH + timedelta(seconds=epoch)
+        except OverflowError:
+            pass
+        return result
@@ -0,0 +1,184 @@
+/* This file is part of Flask-Consent */
+/* Copyright (C) 2020 Jan Dalheimer   */
+
+(function () {
+  var FlaskConsent = window.FlaskConsent = {}
+  FlaskConsent.config = JSON.parse(document.getElementById('flask_consent_config').textContent)
+
+  // Wait this long after the last checkbox change before sending the new consent to the server
+  var SEND_DELAY = 500
+  var pendingSend = null
+  var lastSent = null
+
+  FlaskConsent.hasConsentCookie = function() {
+    var prefix = FlaskConsent.config.cookie_name + '='
+    return document.cookie.split(';').some(function (cookie) {
+      return cookie.trim().indexOf(prefix) === 0
+    })
+  }
+
+  FlaskConsent.sendCookieConsent = function(enabled, keepalive) {
+    var data = enabled
+    if (!Array.isArray(data)) {
+      // Only the categories that have a checkbox have been decided on, a banner may show just the new ones
+      data = {enabled: [], categories: []}
+      document.querySelectorAll('input[name=flask_consent_category]').forEach(function(elem) {
+        data.categories.push(elem.value)
+        if (elem.checked) {
+          data.enabled.push(elem.value)
+        }
+      })
+      data.enabled.sort()
+      data.categories.sort()
+    }
+    if (pendingSend !== null) {
+      clearTimeout(pendingSend)
+      pendingSend = null
+    }
+    var key = JSON.stringify(Array.isArray(data) ? data.slice().sort() : data)
+    if (key === lastSent) {
+      return
+    }
+    lastSent = key
+    var port = location.port ? (':' + location.port) : ''
+    FlaskConsent.config.domains.forEach(function (domain) {
+      var url = location.protocol + '//' + domain + port + FlaskConsent.config.consent_url
+      if (keepalive && window.fetch) {
+        // The page is going away, a keepalive request outlives it where an XHR would be cancelled
+        fetch(url, {method: 'POST', credentials: 'include', keepalive: true,
+                    headers: {'Content-Type': 'application/json'}, body: JSON.stringify(data)})
+        return
+      }
+      var req = new XMLHttpRequest()
+      req.withCredentials = true
+      req.open('POST', url)
+      req.setRequestHeader('Content-Type', 'application/json')
+      req.send(JSON.stringify(data))
+    })
+  }
+
+  FlaskConsent.scheduleCookieConsent = function() {
+    if (pendingSend !== null) {
+      clearTimeout(pendingSend)
+    }
+    pendingSend = setTimeout(FlaskConsent.sendCookieConsent, SEND_DELAY)
+  }
+
+  FlaskConsent.flushCookieConsent = function() {
+    // A change the visitor made right before leaving the page (the full consent page has no close button) is sent now
+    if (pendingSend !== null) {
+      FlaskConsent.sendCookieConsent(undefined, true)
+    }
+  }
+
+  window.addEventListener('pagehide', FlaskConsent.flushCookieConsent)
+  document.addEventListener('visibilitychange', function() {
+    if (document.visibilityState === 'hidden') {
+      FlaskConsent.flushCookieConsent()
+    }
+  })
+
+  FlaskConsent.addCookieConsentBanner = function() {
+    var template = document.getElementById('flask_consent_banner')
+    if (!template) {
+      return
+    }
+    var bannerElement = document.createElement('div')
+    bannerElement.innerHTML = template.innerHTML
+    bannerElement.style.position = 'fixed'
+    bannerElement.style.bottom = '0'
+    bannerElement.style.maxWidth = '100%'
+    bannerElement.classList.add('flask-consent-banner')
+    bannerElement.classList.add('shadow-lg')
+    bannerElement.classList.add('border-top')
+    document.getElementsByTagName('body')[0].appendChild(bannerElement)
+    document.getElementById('flask_consent_banner_close').addEventListener('click', function() {
+      FlaskConsent.sendCookieConsent()
+      bannerElement.remove()
+    })
+    bannerElement.querySelectorAll('input[name=flask_consent_category]').forEach(function(el) {
+      el.addEventListener('change', FlaskConsent.scheduleCookieConsent)
+    })
+  }
+
+  FlaskConsent.setup = function() {
+    var config = FlaskConsent.config
+    document.querySelectorAll('input[name=flask_consent_category]').forEach(function (el) {
+      el.addEventListener('change', FlaskConsent.scheduleCookieConsent)
+    })
+    var stale = config.stale
+    if (stale === null) {
+      // The page is cacheable and doesn't know about the consent cookie, look at it ourselves
+      stale = !FlaskConsent.hasConsentCookie()
+    }
+    if (!stale) {
+      return
+    }
+    if (config.is_primary && !config.is_consent_page) {
+      // If we're on the "primary" domain we don't need to fetch information from _ourselves_
+      FlaskConsent.addCookieConsentBanner()
+      return
+    }
+    if (config.sync_mode === 'redirect') {
+      FlaskConsent.redirectToPrimary()
+      return
+    }
+    var req = new XMLHttpRequest()
+    req.withCredentials = true
+    req.onload = function () {
+      var response = JSON.parse(req.responseText)
+      if (response.token) {
+        // A signed copy of the consent on the primary domain, we only need to hand it to our own domain
+        FlaskConsent.applySyncToken(response.token)
+      } else if (!response.stale && response.enabled && response.enabled.length > 0) {
+        FlaskConsent.sendCookieConsent(response.enabled)
+        location.reload()
+      } else if (!config.is_consent_page) {
+        FlaskConsent.addCookieConsentBanner()
+      }
+    }
+    req.open('GET', location.protocol + '//' + config.primary_domain + config.consent_url)
+    req.setRequestHeader('Content-Type', 'application/json')
+    req.send()
+  }
+
+  FlaskConsent.applySyncToken = function(token) {
+    var req = new XMLHttpRequest()
+    req.onload = function () {
+      if (req.status === 200) {
+        location.reload()
+      } else if (!FlaskConsent.config.is_consent_page) {
+        FlaskConsent.addCookieConsentBanner()
+      }
+    }
+    req.open('POST', FlaskConsent.config.consent_url)
+    req.setRequestHeader('Content-Type', 'application/json')
+    req.send(JSON.stringify({token: token}))
+  }
+
+  FlaskConsent.redirectToPrimary = function() {
+    // Only try once per browser session, if we're back here the primary domain didn't have any consent either
+    var key = 'flask_consent_synced'
+    var synced = true
+    try {
+      synced = sessionStorage.getItem(key) !== null
+      sessionStorage.setItem(key, '1')
+    } catch (e) {
+      // sessionStorage is not available, don't risk a redirect loop
+    }
+    if (synced) {
+      if (!FlaskConsent.config.is_consent_page) {
+        FlaskConsent.addCookieConsentBanner()
+      }
+      return
+    }
+    // Our own sync route starts the round trip through the primary domain and brings the browser back to this page
+    location.href = FlaskConsent.config.sync_url + '?next=' + encodeURIComponent(location.pathname + location.search)
+  }
+
+  if (document.readyState === 'loading') {
+    document.addEventListener('DOMContentLoaded', FlaskConsent.setup)
+  } else {
+    FlaskConsent.setup()
+  }
+})()
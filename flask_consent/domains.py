@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+"""Caching of the domain list returned by the domain loader."""
+
+import asyncio
+import contextvars
+import inspect
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+from .metrics import domains_loaded
+
+
+async def _await(awaitable):
+    return await awaitable
+
+
+def run_awaitable(awaitable):
+    """Runs an awaitable to completion from synchronous code, even if called from within a running event loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(_await(awaitable))
+    with ThreadPoolExecutor(1) as executor:
+        return executor.submit(asyncio.run, _await(awaitable)).result()
+
+
+class DomainCache:
+    def __init__(self, state):
+        """
+        Used internally. Caches the result of the domain loader for CONSENT_DOMAINS_TTL seconds.
+
+        Once expired the old value is still served for up to CONSENT_DOMAINS_STALE_TTL seconds while a background
+        thread fetches a new one. After that the next caller loads the domains synchronously.
+        """
+        self._state = state
+        self._lock = threading.Lock()
+        self._domains = None  # type: Tuple[str, ...]
+        self._loaded_at = 0.0
+        self._generation = 0
+        self._refreshing = False
+        self._pending = None  # type: tuple
+
+    def load(self) -> Tuple[str, ...]:
+        """Calls the domain loader, bypassing the cache."""
+        start = time.perf_counter()
+        result = self._state.extension._domain_loader()
+        if inspect.isawaitable(result):
+            result = run_awaitable(result)
+        return self._loaded(result, start)
+
+    async def load_async(self) -> Tuple[str, ...]:
+        """
+        Calls the domain loader without blocking the event loop, bypassing the cache.
+
+        Coroutine functions are awaited, other loaders are run in the default executor (with the current context, so
+        they can still use the request).
+        """
+        start = time.perf_counter()
+        loader = self._state.extension._domain_loader
+        if inspect.iscoroutinefunction(loader):
+            result = await loader()
+        else:
+            context = contextvars.copy_context()
+            result = await asyncio.get_running_loop().run_in_executor(None, context.run, loader)
+            if inspect.isawaitable(result):
+                result = await result
+        return self._loaded(result, start)
+
+    def _loaded(self, result, start: float) -> Tuple[str, ...]:
+        result = tuple(result)
+        duration = time.perf_counter() - start
+        self._state.metrics.observe('domain_loader_seconds', duration)
+        domains_loaded.send(self._state.app, duration=duration)
+        return result
+
+    def get(self) -> Tuple[str, ...]:
+        ttl = self._state.settings.domains_ttl
+        if not ttl:
+            return self.load()
+
+        domains = self._domains
+        if domains is not None:
+            age = time.monotonic() - self._loaded_at
+            if age < ttl:
+                return domains
+            if age < ttl + self._state.settings.domains_stale_ttl:
+                self._refresh_in_background()
+                return domains
+
+        with self._lock:
+            if self._domains is None or time.monotonic() - self._loaded_at >= ttl:
+                self._store(self.load(), self._generation)
+            return self._domains
+
+    async def get_async(self) -> Tuple[str, ...]:
+        """
+        Like get(), but awaits the domain loader instead of blocking.
+
+        Callers on the same event loop that find the cache empty share a single call of the domain loader.
+        """
+        ttl = self._state.settings.domains_ttl
+        if not ttl:
+            return await self.load_async()
+
+        domains = self._domains
+        if domains is not None:
+            age = time.monotonic() - self._loaded_at
+            if age < ttl:
+                return domains
+            if age < ttl + self._state.settings.domains_stale_ttl:
+                self._refresh_in_background()
+                return domains
+
+        loop = asyncio.get_running_loop()
+        pending = self._pending
+        if pending is not None and pending[0] is loop:
+            return await asyncio.shield(pending[1])
+        generation = self._generation
+        task = loop.create_task(self.load_async())
+        self._pending = (loop, task)
+        try:
+            domains = await asyncio.shield(task)
+        finally:
+            if self._pending is not None and self._pending[1] is task:
+                self._pending = None
+        with self._lock:
+            self._store(domains, generation)
+        return domains
+
+    def invalidate(self):
+        """Drops the cached domains, the next call to get() will call the domain loader again."""
+        with self._lock:
+            self._generation += 1
+            self._domains = None
+
+    def _store(self, domains, generation):
+        if generation == self._generation:
+            self._domains = domains
+            self._loaded_at = time.monotonic()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, args=(self._generation,), daemon=True).start()
+
+    def _refresh(self, generation):
+        try:
+            with self._state.app.app_context():
+                domains = self.load()
+            with self._lock:
+                self._store(domains, generation)
+        except Exception:
+            self._state.app.logger.exception('could not refresh consent domains')
+        finally:
+            self._refreshing = False
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+"""Signals and in-process metrics for the consent handling."""
+
+import threading
+from typing import Tuple
+
+from flask.signals import Namespace
+
+_signals = Namespace()
+
+#: Sent when the consent cookie has been decoded. Arguments: duration (seconds), status (missing, invalid or present)
+cookie_decoded = _signals.signal('consent-cookie-decoded')
+#: Sent when flask_consent_code() has rendered the consent code. Arguments: duration (seconds), banner (bool)
+code_rendered = _signals.signal('consent-code-rendered')
+#: Sent when the domain loader has been called. Arguments: duration (seconds)
+domains_loaded = _signals.signal('consent-domains-loaded')
+#: Sent when the consent endpoint has handled a request. Arguments: method, outcome
+consent_requested = _signals.signal('consent-requested')
+
+
+class MetricsRegistry:
+    def __init__(self, enabled: bool = True):
+        """
+        A minimal, thread safe registry of counters and timings.
+
+        Timings are kept as a count and a sum, like a Prometheus summary without quantiles. When disabled all
+        recording methods return immediately.
+        """
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = {}  # type: dict
+        self._timings = {}  # type: dict
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        with self._lock:
+            timing = self._timings.setdefault(name, [0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+
+    def counter(self, name: str, **labels) -> float:
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def timing(self, name: str) -> Tuple[int, float]:
+        """Returns the number of observations and their sum in seconds."""
+        count, total = self._timings.get(name, (0, 0.0))
+        return count, total
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+    def snapshot(self) -> Tuple[dict, dict]:
+        with self._lock:
+            return dict(self._counters), {name: tuple(timing) for name, timing in self._timings.items()}
+
+
+def render_prometheus(registry: MetricsRegistry, prefix: str = 'flask_consent_') -> str:
+    """Renders the metrics in the Prometheus text exposition format."""
+    counters, timings = registry.snapshot()
+    lines = []
+    for name in sorted({name for name, _ in counters}):
+        lines.append('# TYPE {}{} counter'.format(prefix, name))
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name != name:
+                continue
+            label_str = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for k, v in labels)
+            lines.append('{}{}{} {}'.format(prefix, name, '{' + label_str + '}' if label_str else '', value))
+    for name, (count, total) in sorted(timings.items()):
+        lines.append('# TYPE {}{} summary'.format(prefix, name))
+        lines.append('{}{}_count {}'.format(prefix, name, count))
+        lines.append('{}{}_sum {}'.format(prefix, name, total))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+"""Server side storage of consent for authenticated users."""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import FrozenSet, Hashable, Optional
+
+
+@dataclass(frozen=True)
+class StoredConsent:
+    """
+    The consent a user has given, as kept in a ConsentStore.
+
+    decided holds the categories the user has made a choice about, like in the consent cookie. None (for consent
+    stored before this was recorded) is taken to cover all categories.
+    """
+
+    enabled: FrozenSet[str]
+    last_updated: datetime
+    decided: Optional[FrozenSet[str]] = None
+
+
+class ConsentStore:
+    """Base class for server side consent stores, keyed by user id."""
+
+    def get(self, user_id: Hashable) -> Optional[StoredConsent]:
+        raise NotImplementedError
+
+    def set(self, user_id: Hashable, consent: StoredConsent):
+        raise NotImplementedError
+
+
+class SQLiteConsentStore(ConsentStore):
+    def __init__(self, path: str, table: str = 'flask_consent'):
+        """
+        A reference store keeping consent in a SQLite database.
+
+        A single connection is shared (and serialized) between threads, wrap it in a CachedConsentStore to avoid
+        hitting the database on every request.
+        """
+        self.table = table
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS {} (user_id TEXT PRIMARY KEY, enabled TEXT NOT NULL, '
+                'last_updated TEXT NOT NULL, decided TEXT)'.format(self.table))
+            columns = {row[1] for row in self._connection.execute('PRAGMA table_info({})'.format(self.table))}
+            if 'decided' not in columns:
+                # tables created by earlier versions, existing rows are read as decided on all categories
+                self._connection.execute('ALTER TABLE {} ADD COLUMN decided TEXT'.format(self.table))
+
+    def get(self, user_id: Hashable) -> Optional[StoredConsent]:
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT enabled, last_updated, decided FROM {} WHERE user_id = ?'.format(self.table),
+                (str(user_id),)).fetchone()
+        if row is None:
+            return None
+        return StoredConsent(frozenset(json.loads(row[0])), datetime.fromisoformat(row[1]),
+                             None if row[2] is None else frozenset(json.loads(row[2])))
+
+    def set(self, user_id: Hashable, consent: StoredConsent):
+        decided = None if consent.decided is None else json.dumps(sorted(consent.decided))
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO {} (user_id, enabled, last_updated, decided) VALUES (?, ?, ?, ?)'.format(
+                    self.table),
+                (str(user_id), json.dumps(sorted(consent.enabled)), consent.last_updated.isoformat(), decided))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class CachedConsentStore(ConsentStore):
+    def __init__(self, store: ConsentStore, maxsize: int = 1024, ttl: float = 300):
+        """
+        An in-process read-through LRU cache in front of another store.
+
+        Both found and missing entries are cached for ttl seconds, writes go through to the underlying store. If
+        several processes write to the same store a user may see outdated consent for up to ttl seconds.
+        """
+        self.store = store
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # type: OrderedDict
+
+    def get(self, user_id: Hashable) -> Optional[StoredConsent]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+        consent = self.store.get(user_id)
+        self._put(user_id, consent)
+        return consent
+
+    def set(self, user_id: Hashable, consent: StoredConsent):
+        self.store.set(user_id, consent)
+        self._put(user_id, consent)
+
+    def invalidate(self, user_id: Hashable = None):
+        """Drops the cached entry for a user, or the entire cache if no user is given."""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def _put(self, user_id: Hashable, consent: Optional[StoredConsent]):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, consent)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+"""Signed tokens used to synchronize consent from the primary domain to the other domains."""
+
+from datetime import datetime, timedelta
+from typing import Iterable, Optional, Set, Tuple
+
+from itsdangerous import BadData, URLSafeTimedSerializer
+
+from .codec import EPOCH
+
+
+class SyncTokens:
+    def __init__(self, secret_key, max_age: int):
+        """
+        Creates and verifies short-lived, HMAC signed tokens carrying the consent given on the primary domain.
+
+        All domains need to share the same secret key.
+        """
+        self.max_age = max_age
+        self._serializer = URLSafeTimedSerializer(secret_key, salt='flask-consent-sync')
+
+    def dumps(self, enabled: Iterable[str], last_updated: datetime) -> str:
+        return self._serializer.dumps(dict(e=sorted(enabled), t=int((last_updated - EPOCH).total_seconds())))
+
+    def loads(self, token: str) -> Optional[Tuple[Set[str], datetime]]:
+        """Returns the enabled categories and the time consent was given, or None if the token is invalid."""
+        try:
+            data = self._serializer.loads(token, max_age=self.max_age)
+            enabled, timestamp = data['e'], data['t']
+        except (BadData, KeyError, TypeError):
+            return None
+        if not isinstance(enabled, list) or not all(isinstance(e, str) for e in enabled):
+            return None
+        if not isinstance(timestamp, int):
+            return None
+        return set(enabled), EPOCH + timedelta(seconds=timestamp)
@@ -17,7 +17,10 @@ setup(
     install_requires=[
         'Flask>=1.0.0'
     ],
-    package_data=dict(flask_consent=['injection.html']),
+    extras_require={
+        'async': ['Flask[async]>=2.0'],
+    },
+    package_data=dict(flask_consent=['injection.html', 'consent.js']),
     setup_requires=['pytest-runner'],
     test_suite='tests',
     tests_require=[
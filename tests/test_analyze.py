@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from flask_consent import ConsentCookie, JsonCookieCodec
+from flask_consent.analyze import ConsentAggregate, analyze, staleness_bucket
+
+from test_consent import make_app_and_consent
+
+NOW = datetime(2020, 6, 1)
+
+
+class AnalyzeTest(unittest.TestCase):
+    def setUp(self):
+        self.app, self.consent = make_app_and_consent()
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def cookie(self, enabled, last_updated):
+        return self.consent.cookie_codec.encode(self.consent.categories, ConsentCookie(set(enabled), last_updated))
+
+    def write_log(self, name, lines):
+        path = os.path.join(self.dir.name, name)
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(path, 'wt', encoding='utf-8') as f:
+            f.write(''.join(line + '\n' for line in lines))
+        return path
+
+    def line(self, host, cookie):
+        return '{} 127.0.0.1 - - "GET / HTTP/1.1" 200 2 "-" "Mozilla" "theme=dark; _consent={}"'.format(host, cookie)
+
+    def run_analyze(self, *paths, **kwargs):
+        return analyze(paths, self.consent.cookie_codec, self.consent.categories, '_consent', timedelta(days=365),
+                       now=NOW, **kwargs)
+
+    def test_aggregate(self):
+        path = self.write_log('access.log', [
+            self.line('a.test', self.cookie({'required', 'analytics'}, datetime(2020, 5, 20))),
+            self.line('b.test', self.cookie({'required'}, datetime(2018, 5, 20))),
+            self.line('a.test', 'garbage'),
+            '127.0.0.1 - - "GET / HTTP/1.1" 200 2 "-" "Mozilla" "-"',
+        ])
+        result = self.run_analyze(path, domain_regex=r'^(\S+)').to_dict()
+        self.assertEqual(result['total'], 2)
+        self.assertEqual(result['invalid'], 1)
+        self.assertEqual(result['expired'], 1)
+        self.assertEqual(result['categories'], dict(required=2, analytics=1))
+        self.assertEqual(result['domains']['a.test'], dict(total=1, categories=dict(analytics=1, required=1)))
+        self.assertEqual(result['months']['2018-05'], dict(total=1, categories=dict(required=1)))
+        self.assertEqual(result['staleness']['0-30'], 1)
+        self.assertEqual(result['staleness']['730+'], 1)
+
+    def test_quoted_json_cookie_in_gzip(self):
+        value = JsonCookieCodec().encode(self.consent.categories, ConsentCookie({'preferences'}, datetime(2020, 1, 1)))
+        quoted = '"' + value.replace('"', '\\"').replace(',', '\\054') + '"'
+        non_list = '"' + json.dumps(dict(enabled='x', last_updated='2020-01-01T00:00:00')).replace('"', '\\"') + '"'
+        path = self.write_log('access.log.gz', [self.line('a.test', quoted), self.line('a.test', non_list)])
+        result = self.run_analyze(path).to_dict()
+        self.assertEqual(result['total'], 2)
+        self.assertEqual(result['categories'], dict(preferences=1))
+        self.assertEqual(result['months']['2020-01']['total'], 2)
+
+    def test_hostile_cookies(self):
+        def quote(data):
+            return '"' + json.dumps(data).replace('"', '\\"').replace(',', '\\054') + '"'
+
+        path = self.write_log('access.log', [
+            self.line('a.test', quote(dict(enabled=[[1]], last_updated='2020-01-01T00:00:00'))),
+            self.line('a.test', quote(dict(enabled=['required'], last_updated='2020-01-01T00:00:00+02:00'))),
+            self.line('a.test', self.cookie({'required'}, datetime(2020, 5, 1))),
+        ])
+        result = self.run_analyze(path).to_dict()
+        self.assertEqual(result['total'], 1)
+        self.assertEqual(result['invalid'], 2)
+
+    def test_aggregate_rejects_bad_values(self):
+        aggregate = ConsentAggregate(NOW, timedelta(days=365))
+        aggregate.add('', ConsentCookie([['required']], datetime(2020, 1, 1)))
+        aggregate.add('', ConsentCookie({1}, datetime(2020, 1, 1)))
+        aggregate.add('', ConsentCookie({'required'}, datetime(2020, 1, 1, tzinfo=timezone.utc)))
+        aggregate.add('', ConsentCookie({'required'}, datetime(2020, 1, 1)))
+        self.assertEqual((aggregate.total, aggregate.invalid), (1, 3))
+        self.assertEqual(aggregate.to_dict()['categories'], dict(required=1))
+
+    def test_multiple_processes(self):
+        lines = [self.line('a.test', self.cookie({'required'}, datetime(2020, 5, 1)))] * 10
+        paths = [self.write_log('access{}.log'.format(i), lines) for i in range(3)]
+        result = self.run_analyze(*paths, jobs=2).to_dict()
+        self.assertEqual(result['total'], 30)
+        self.assertEqual(result, self.run_analyze(*paths).to_dict())
+
+    def test_staleness_bucket(self):
+        self.assertEqual(staleness_bucket(timedelta(days=0)), '0-30')
+        self.assertEqual(staleness_bucket(timedelta(days=30)), '30-90')
+        self.assertEqual(staleness_bucket(timedelta(days=1000)), '730+')
+
+    def test_cli(self):
+        path = self.write_log('access.log', [self.line('a.test', self.cookie({'required'}, datetime(2020, 5, 1)))])
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['consent', 'analyze', '--jobs', '1', path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(json.loads(result.output)['categories'], dict(required=1))
+
+        result = runner.invoke(args=['consent', 'analyze', '--format', 'csv', path])
+        self.assertEqual(result.exit_code, 0, result.output)
+        rows = list(csv.reader(io.StringIO(result.output)))
+        self.assertEqual(rows[0], ['dimension', 'key', 'category', 'count'])
+        self.assertIn(['category', '', 'required', '1'], rows)
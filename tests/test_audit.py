@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime
+
+from flask_testing import TestCase
+
+from flask_consent.audit import AuditEvent, AuditLog, AuditSink, JsonLinesAuditSink, SQLiteAuditSink
+from flask_consent.store import SQLiteConsentStore, StoredConsent
+
+from test_consent import make_app_and_consent
+
+
+def make_event(domain='primary.test'):
+    return AuditEvent(datetime(2020, 7, 18), domain, None, frozenset({'required'}))
+
+
+class ListSink(AuditSink):
+    def __init__(self):
+        self.batches = []
+        self.closed = False
+        self.blocker = threading.Event()
+        self.blocker.set()
+
+    def write(self, events):
+        self.blocker.wait()
+        self.batches.append(list(events))
+
+    def close(self):
+        self.closed = True
+
+
+class AuditLogTest(unittest.TestCase):
+    def test_batches_and_close(self):
+        sink = ListSink()
+        log = AuditLog(sink, batch_size=10)
+        for _ in range(25):
+            self.assertTrue(log.record(make_event()))
+        log.close()
+        self.assertEqual(sum(len(batch) for batch in sink.batches), 25)
+        self.assertTrue(all(len(batch) <= 10 for batch in sink.batches))
+        self.assertEqual(log.written, 25)
+        self.assertTrue(sink.closed)
+
+    def test_drop_new(self):
+        sink = ListSink()
+        sink.blocker.clear()
+        log = AuditLog(sink, maxsize=2, batch_size=1)
+        log.record(make_event('first'))
+        # wait until the worker is blocked writing the first event
+        while log._queue.qsize():
+            pass
+        log.record(make_event('second'))
+        log.record(make_event('third'))
+        self.assertFalse(log.record(make_event('fourth')))
+        self.assertEqual(log.dropped, 1)
+        sink.blocker.set()
+        log.close()
+        self.assertListEqual([batch[0].domain for batch in sink.batches], ['first', 'second', 'third'])
+
+    def test_drop_oldest(self):
+        sink = ListSink()
+        sink.blocker.clear()
+        log = AuditLog(sink, maxsize=2, batch_size=1, policy=AuditLog.DROP_OLDEST)
+        log.record(make_event('first'))
+        while log._queue.qsize():
+            pass
+        for domain in ('second', 'third', 'fourth'):
+            self.assertTrue(log.record(make_event(domain)))
+        self.assertEqual(log.dropped, 1)
+        sink.blocker.set()
+        log.close()
+        self.assertListEqual([batch[0].domain for batch in sink.batches], ['first', 'third', 'fourth'])
+
+    def test_waits_to_fill_batch(self):
+        sink = ListSink()
+        log = AuditLog(sink, batch_size=10, flush_interval=60)
+        for _ in range(3):
+            log.record(make_event())
+        time.sleep(0.05)
+        self.assertListEqual(sink.batches, [])
+        log.flush()
+        self.assertListEqual([len(batch) for batch in sink.batches], [3])
+        log.close()
+
+    def test_flush_interval(self):
+        sink = ListSink()
+        log = AuditLog(sink, batch_size=10, flush_interval=0.05)
+        for _ in range(3):
+            log.record(make_event())
+        for _ in range(100):
+            if sink.batches:
+                break
+            time.sleep(0.01)
+        self.assertListEqual([len(batch) for batch in sink.batches], [3])
+        log.close()
+
+    def test_close_timeout_leaves_sink_to_worker(self):
+        sink = ListSink()
+        sink.blocker.clear()
+        log = AuditLog(sink, batch_size=1)
+        log.record(make_event('first'))
+        log.record(make_event('second'))
+        log.close(timeout=0.05)
+        # the worker is still writing, the sink must not be used or closed from another thread
+        self.assertFalse(sink.closed)
+        self.assertListEqual(sink.batches, [])
+        sink.blocker.set()
+        log._thread.join(5)
+        self.assertListEqual([batch[0].domain for batch in sink.batches], ['first', 'second'])
+        self.assertTrue(sink.closed)
+
+    def test_record_after_close(self):
+        log = AuditLog(ListSink())
+        log.close()
+        self.assertFalse(log.record(make_event()))
+        self.assertEqual(log.dropped, 1)
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, lambda: AuditLog(ListSink(), policy='explode'))
+
+    def test_json_lines_sink(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'audit.jsonl')
+            log = AuditLog(JsonLinesAuditSink(path))
+            log.record(make_event())
+            log.close()
+            with open(path) as f:
+                self.assertDictEqual(json.loads(f.readline()), dict(
+                    timestamp='2020-07-18T00:00:00', domain='primary.test', user_id=None, enabled=['required']))
+
+    def test_sqlite_sink(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'audit.db')
+            log = AuditLog(SQLiteAuditSink(path))
+            log.record(make_event())
+            log.record(make_event())
+            log.close()
+            with sqlite3.connect(path) as connection:
+                self.assertEqual(connection.execute('SELECT COUNT(*) FROM flask_consent_audit').fetchone()[0], 2)
+
+
+class AuditIntegrationTest(TestCase):
+    def create_app(self):
+        app, consent = make_app_and_consent()
+        self.sink = ListSink()
+        self.log = AuditLog(self.sink)
+        consent.set_audit_log(self.log)
+        consent.user_loader(lambda: 42)
+        self.store = SQLiteConsentStore(':memory:')
+        consent.set_store(self.store)
+        return app
+
+    def events(self):
+        self.log.flush()
+        return [event for batch in self.sink.batches for event in batch]
+
+    def tearDown(self):
+        self.log.close()
+
+    def test_change_recorded(self):
+        self.client.post('/consent', json=['required'])
+        self.client.post('/consent', json=['required'])
+        self.client.get('/')
+        events = self.events()
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].user_id, '42')
+        self.assertEqual(events[0].domain, 'localhost')
+        self.assertSetEqual(events[0].enabled, {'required'})
+
+    def test_stored_consent_not_recorded(self):
+        self.store.set(42, StoredConsent(frozenset({'required'}), datetime(2020, 7, 18)))
+        response = self.client.get('/')
+        self.assertIn('Set-Cookie', response.headers)
+        self.client.get('/consent')
+        self.assertEqual(self.events(), [])
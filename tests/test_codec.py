@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+import json
+import unittest
+from datetime import datetime
+
+from flask_consent import Consent, ConsentCookie, CompactCookieCodec, JsonCookieCodec
+
+
+class CodecTest(unittest.TestCase):
+    def setUp(self):
+        self.consent = Consent()
+        self.consent.add_standard_categories()
+        self.categories = self.consent.categories
+        self.last_updated = datetime(2020, 7, 18, 21, 52, 5)
+
+    def test_compact_roundtrip(self):
+        codec = CompactCookieCodec()
+        value = codec.encode(self.categories, ConsentCookie({'required', 'analytics'}, self.last_updated))
+        self.assertEqual(value, '1.5.5f136f05')
+        cookie = codec.decode(self.categories, value)
+        self.assertSetEqual(cookie.enabled, {'required', 'analytics'})
+        self.assertEqual(cookie.last_updated, self.last_updated)
+
+    def test_compact_decided(self):
+        codec = CompactCookieCodec()
+        cookie = ConsentCookie({'analytics'}, self.last_updated, {'analytics', 'required'})
+        value = codec.encode(self.categories, cookie)
+        self.assertEqual(value, '2.4.5f136f05.5')
+        cookie = codec.decode(self.categories, value)
+        self.assertSetEqual(cookie.enabled, {'analytics'})
+        self.assertSetEqual(cookie.decided, {'analytics', 'required'})
+        self.assertIsNone(codec.decode(self.categories, '1.5.5f136f05').decided)
+
+    def test_json_decided(self):
+        codec = JsonCookieCodec()
+        value = codec.encode(self.categories, ConsentCookie({'analytics'}, self.last_updated, {'analytics'}))
+        self.assertSetEqual(codec.decode(self.categories, value).decided, {'analytics'})
+
+    def test_compact_reads_json(self):
+        value = json.dumps(dict(enabled=['preferences'], last_updated=self.last_updated.isoformat()))
+        cookie = CompactCookieCodec().decode(self.categories, value)
+        self.assertSetEqual(cookie.enabled, {'preferences'})
+        self.assertEqual(cookie.last_updated, self.last_updated)
+
+    def test_compact_invalid(self):
+        codec = CompactCookieCodec()
+        values = ('', '2.1.1', '1.x.1', '1.1', '{not json', '{"enabled": [[1]]}', '{"enabled": ["required", 1]}',
+                  '{"enabled": ["required"], "last_updated": "2020-07-18T21:52:05+02:00"}')
+        for value in values:
+            cookie = codec.decode(self.categories, value)
+            self.assertIsNone(cookie.enabled)
+            self.assertIsNone(cookie.last_updated)
+
+    def test_json_non_list_enabled(self):
+        cookie = JsonCookieCodec().decode(self.categories, '{"enabled": "required"}')
+        self.assertSetEqual(cookie.enabled, set())
+        self.assertIsNone(cookie.last_updated)
+
+    def test_category_index(self):
+        self.assertEqual([c.index for c in self.categories.values()], [0, 1, 2])
+        self.assertEqual(self.consent.add_category('marketing', 'Marketing', '', default=False).index, 3)
+        self.assertEqual(self.consent.add_category('required', 'Required', '', default=True).index, 0)
+        self.assertEqual(self.consent.add_category('social', 'Social', '', default=False, index=10).index, 10)
+        self.assertRaises(ValueError,
+                          lambda: self.consent.add_category('video', 'Video', '', default=False, index=10))
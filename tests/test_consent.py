@@ -3,21 +3,32 @@
 # This file is part of Flask-Consent
 # Copyright (C) 2020 Jan Dalheimer
 
+import asyncio
+import importlib.util
+import json
+import re
+import threading
+import time
 import unittest
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
 
-from flask import Flask, jsonify, request, render_template_string
+from flask import Blueprint, Flask, jsonify, request, render_template, render_template_string
 from flask.testing import FlaskClient
 from flask_testing import TestCase
 
-from flask_consent import Consent, ConsentData
+from flask_consent import Consent, ConsentData, consent_required
+from flask_consent.metrics import consent_requested, cookie_decoded
+from flask_consent.sync import SyncTokens
 
 
-def make_app_and_consent():
+def make_app_and_consent(**config):
     app = Flask(__name__)
     app.config['CONSENT_FULL_TEMPLATE'] = 'full.html'
     app.config['CONSENT_BANNER_TEMPLATE'] = 'banner.html'
     app.config['CONSENT_CONTACT_MAIL'] = 'test@test.test'
     app.config['CONSENT_PRIMARY_SERVERNAME'] = 'primary.test'
+    app.config.update(config)
     consent = Consent(app)
     consent.add_standard_categories()
 
@@ -95,6 +106,25 @@ class WebTest(TestCase):
             analytics=True
         ))
 
+    def test_unchanged_consent_not_resent(self):
+        resp = self.client.post('/consent', json=['required', 'preferences'])
+        self.assertIn('Set-Cookie', resp.headers)
+        resp = self.client.post('/consent', json=['preferences', 'required'])
+        self.assertStatus(resp, 204)
+        self.assertEqual(resp.data, b'')
+        self.assertNotIn('Set-Cookie', resp.headers)
+
+    def test_accept_defaults_sets_cookie(self):
+        resp = self.client.post('/consent', json=['required', 'preferences', 'analytics'])
+        self.assert200(resp)
+        self.assertIn('Set-Cookie', resp.headers)
+
+    def test_vary_cookie(self):
+        resp = self.client.get('/banner')
+        self.assertIn('Cookie', resp.headers['Vary'])
+        resp = self.client.get('/consent/consent.0000.js')
+        self.assertNotIn('Vary', resp.headers)
+
     def test_render_banner(self):
         resp = self.client.get('/banner')
         self.assert200(resp)
@@ -104,16 +134,172 @@ class WebTest(TestCase):
         self.assert200(resp)
         self.assertNotIn('id="flask_consent_banner"', resp.data.decode(resp.charset))
 
+    def test_script_asset(self):
+        resp = self.client.get('/banner')
+        match = re.search(r'src="(/consent/consent\.([0-9a-f]+)\.js)"', resp.data.decode(resp.charset))
+        self.assertIsNotNone(match)
+        resp = self.client.get(match.group(1))
+        self.assert200(resp)
+        self.assertEqual(resp.mimetype, 'application/javascript')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('FlaskConsent.setup', resp.data.decode(resp.charset))
+        resp = self.client.get(match.group(1), headers={'If-None-Match': '"{}"'.format(match.group(2))})
+        self.assertStatus(resp, 304)
+
+    def test_script_asset_old_version(self):
+        resp = self.client.get('/consent/consent.0000.js')
+        self.assert200(resp)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+
     def test_post_invalid_type(self):
         resp = self.client.post('/consent', json=dict(foo='bar'))
         self.assert400(resp)
         self.assertDictEqual(resp.json, dict(msg='payload is not a list'))
 
+    def test_legacy_json_cookie(self):
+        self.client.set_cookie('localhost', '_consent', json.dumps(dict(
+            enabled=['required'], last_updated=datetime.utcnow().isoformat())))
+        resp = self.client.get('/banner')
+        self.assert200(resp)
+        self.assertNotIn('id="flask_consent_banner"', resp.data.decode(resp.charset))
+        resp = self.client.get('/')
+        self.assertDictEqual(resp.json, dict(
+            required=True,
+            preferences=False,
+            analytics=False
+        ))
+
+    def test_post_sets_compact_cookie(self):
+        resp = self.client.post('/consent', json=['required', 'analytics'])
+        self.assert200(resp)
+        self.assertRegex(resp.headers['Set-Cookie'], r'^_consent=2\.5\.[0-9a-f]+\.7;')
+
     def test_post_unknown_category(self):
         resp = self.client.post('/consent', json=['foo'])
         self.assert400(resp)
         self.assertDictEqual(resp.json, dict(msg='invalid consent category specified: foo'))
 
+    def test_post_unhashable_category(self):
+        for payload in ([['required']], dict(enabled=[{'a': 1}]), dict(enabled=['required'], categories=[['x']])):
+            resp = self.client.post('/consent', json=payload)
+            self.assert400(resp)
+            self.assertTrue(resp.json['msg'].startswith('invalid consent category specified'))
+
+
+class PartialConsentTest(TestCase):
+    def create_app(self):
+        app, self.consent = make_app_and_consent()
+        self.banner_categories = []
+
+        def recording_render(template, **kwargs):
+            if template == 'banner.html':
+                self.banner_categories.append([c.name for c in kwargs['flask_consent_categories']])
+            return render_template(template, **kwargs)
+
+        self.consent.set_render_template_func(recording_render)
+        return app
+
+    def add_marketing(self):
+        self.client.post('/consent', json=['required', 'preferences'])
+        self.consent.add_category('marketing', 'Marketing', 'Ads', default=True)
+
+    def test_new_category_is_undecided(self):
+        self.add_marketing()
+        resp = self.client.get('/consent', content_type='application/json')
+        self.assertTrue(resp.json['stale'])
+        self.assertSetEqual(set(resp.json['enabled']), {'required', 'preferences', 'marketing'})
+
+    def test_banner_shows_undecided_categories(self):
+        self.client.get('/banner')
+        self.add_marketing()
+        resp = self.client.get('/banner')
+        self.assertIn('id="flask_consent_banner"', resp.data.decode(resp.charset))
+        self.assertEqual(self.banner_categories, [['required', 'preferences', 'analytics'], ['marketing']])
+
+    def test_partial_decision(self):
+        self.add_marketing()
+        resp = self.client.post('/consent', json=dict(enabled=[], categories=['marketing']))
+        self.assert200(resp)
+        self.assertSetEqual(set(resp.json['enabled']), {'required', 'preferences'})
+        resp = self.client.get('/banner')
+        self.assertNotIn('id="flask_consent_banner"', resp.data.decode(resp.charset))
+
+    def test_partial_decision_invalid_category(self):
+        resp = self.client.post('/consent', json=dict(enabled=[], categories=['unknown']))
+        self.assert400(resp)
+
+    def test_legacy_cookie_covers_all_categories(self):
+        with self.app.test_request_context(headers={'Cookie': '_consent=1.3.' + format(int(time.time()), 'x')}):
+            self.app.preprocess_request()
+            self.assertFalse(request.consent.is_stale())
+            self.consent.add_category('marketing', 'Marketing', 'Ads', default=False)
+            self.assertTrue(request.consent.is_partially_stale())
+            self.assertSetEqual(request.consent.undecided, {'marketing'})
+
+    def test_set_item_decides(self):
+        self.add_marketing()
+        with self.app.test_request_context():
+            self.app.preprocess_request()
+            request.consent.replace(['required'])
+            self.consent.add_category('social', 'Social', '', default=False)
+            self.assertSetEqual(request.consent.undecided, {'social'})
+            request.consent['social'] = False
+            self.assertFalse(request.consent.is_stale())
+
+
+class DecisionsTest(TestCase):
+    def create_app(self):
+        app, self.consent = make_app_and_consent()
+
+        @app.route('/tags')
+        def tags():
+            return render_template_string('{% if consent.analytics %}analytics{% endif %}'
+                                          '{% if consent.unknown %}unknown{% endif %}')
+
+        @app.route('/analytics')
+        @consent_required('analytics')
+        def analytics():
+            return 'tracked'
+
+        @app.route('/preferences')
+        @consent_required(self.consent.categories['preferences'], fallback=lambda: 'no preferences')
+        def preferences():
+            return 'preferences'
+
+        return app
+
+    def test_decisions(self):
+        with self.app.test_request_context():
+            self.app.preprocess_request()
+            decisions = request.consent.decisions
+            self.assertTrue(decisions.required)
+            self.assertTrue(decisions[self.consent.categories['analytics']])
+            self.assertDictEqual(dict(decisions), dict(required=True, preferences=True, analytics=True))
+            self.assertIs(request.consent.decisions, decisions)
+            self.assertRaises(AttributeError, lambda: setattr(decisions, 'analytics', False))
+            request.consent['analytics'] = False
+            self.assertFalse(request.consent.decisions.analytics)
+            self.assertTrue(decisions.analytics)
+
+    def test_template(self):
+        self.assertEqual(self.client.get('/tags').data, b'analytics')
+        self.client.post('/consent', json=['required'])
+        self.assertEqual(self.client.get('/tags').data, b'')
+
+    def test_consent_required(self):
+        self.assertEqual(self.client.get('/analytics').data, b'tracked')
+        self.assertEqual(self.client.get('/preferences').data, b'preferences')
+        self.client.post('/consent', json=['required'])
+        self.assert403(self.client.get('/analytics'))
+        self.assertEqual(self.client.get('/preferences').data, b'no preferences')
+
+    def test_category_names_do_not_hide_methods(self):
+        for name in ('get', 'keys', 'items', 'values', '__len__'):
+            self.assertRaises(ValueError, self.consent.add_category, name, name, '', default=True)
+        with self.app.test_request_context():
+            self.app.preprocess_request()
+            self.assertTrue(request.consent.decisions.get('analytics'))
+
 
 class MultiDomainTest(TestCase):
     def create_app(self):
@@ -133,6 +319,572 @@ class MultiDomainTest(TestCase):
         self.assertIn('another.test', resp.data.decode(resp.charset))
 
 
+class CacheTest(TestCase):
+    def create_app(self):
+        app, self.consent = make_app_and_consent()
+        self.banner_renders = 0
+
+        def counting_render(template, **kwargs):
+            if template == 'banner.html':
+                self.banner_renders += 1
+            return render_template(template, **kwargs)
+
+        self.consent.set_render_template_func(counting_render)
+        return app
+
+    def test_banner_cached(self):
+        self.client.get('/banner')
+        self.client.get('/banner')
+        self.assertEqual(self.banner_renders, 1)
+
+    def test_add_category_invalidates_banner(self):
+        self.client.get('/banner')
+        self.consent.add_category('marketing', 'Marketing', 'Ads', default=False)
+        self.client.get('/banner')
+        self.assertEqual(self.banner_renders, 2)
+
+    def test_banner_cache_disabled(self):
+        self.app.config['CONSENT_CACHE_BANNER'] = False
+        self.consent.reload_settings(self.app)
+        self.client.get('/banner')
+        self.client.get('/banner')
+        self.assertEqual(self.banner_renders, 2)
+
+
+class ConditionalTest(TestCase):
+    def create_app(self):
+        app, self.consent = make_app_and_consent(CONSENT_CACHE_FULL_PAGE=True)
+        self.page_renders = 0
+
+        def counting_render(template, **kwargs):
+            if template == 'full.html':
+                self.page_renders += 1
+            return render_template(template, **kwargs)
+
+        self.consent.set_render_template_func(counting_render)
+        return app
+
+    def test_json_not_modified(self):
+        resp = self.client.get('/consent', content_type='application/json')
+        self.assert200(resp)
+        self.assertIn('no-cache', resp.headers['Cache-Control'])
+        etag = resp.headers['ETag']
+        resp = self.client.get('/consent', content_type='application/json', headers={'If-None-Match': etag})
+        self.assertStatus(resp, 304)
+        self.assertEqual(resp.headers['ETag'], etag)
+
+    def test_json_etag_changes_with_consent(self):
+        etag = self.client.get('/consent', content_type='application/json').headers['ETag']
+        self.client.post('/consent', json=['required'])
+        resp = self.client.get('/consent', content_type='application/json', headers={'If-None-Match': etag})
+        self.assert200(resp)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_json_with_token_not_cached(self):
+        self.app.secret_key = 'secret'
+        self.client.post('/consent', json=['required'])
+        resp = self.client.get('/consent', content_type='application/json')
+        self.assertIn('token', resp.json)
+        self.assertNotIn('ETag', resp.headers)
+        self.assertIn('no-store', resp.headers['Cache-Control'])
+
+    def test_not_modified_allows_origin(self):
+        etag = self.client.get('/consent', content_type='application/json').headers['ETag']
+        resp = self.client.get('/consent', content_type='application/json',
+                               headers={'If-None-Match': etag, 'Origin': 'https://primary.test'})
+        self.assertStatus(resp, 304)
+        self.assertEqual(resp.headers['Access-Control-Allow-Origin'], 'https://primary.test')
+
+    def test_page_cached(self):
+        etag = self.client.get('/consent').headers['ETag']
+        self.client.get('/consent')
+        self.assertEqual(self.page_renders, 1)
+        self.assertStatus(self.client.get('/consent', headers={'If-None-Match': etag}), 304)
+        self.consent.add_category('marketing', 'Marketing', 'Ads', default=False)
+        self.assert200(self.client.get('/consent', headers={'If-None-Match': etag}))
+        self.assertEqual(self.page_renders, 2)
+
+    def test_page_cache_disabled(self):
+        self.app.config['CONSENT_CACHE_FULL_PAGE'] = False
+        self.consent.reload_settings(self.app)
+        resp = self.client.get('/consent')
+        self.assertNotIn('ETag', resp.headers)
+        self.client.get('/consent')
+        self.assertEqual(self.page_renders, 2)
+
+
+class CacheableTest(TestCase):
+    def create_app(self):
+        app, consent = make_app_and_consent(CONSENT_CACHEABLE=True)
+
+        @app.route('/disable-analytics')
+        def disable_analytics():
+            request.consent['analytics'] = False
+            return jsonify()
+
+        return app
+
+    def test_same_output_for_all_visitors(self):
+        first = self.client.get('/banner')
+        self.assertIn('id="flask_consent_banner"', first.data.decode(first.charset))
+        self.assertNotIn('Cookie', first.headers.get('Vary', ''))
+        self.client.post('/consent', json=['required'])
+        second = self.client.get('/banner')
+        self.assertEqual(first.data, second.data)
+        self.assertNotIn('Cookie', second.headers.get('Vary', ''))
+
+    def test_no_set_cookie_on_cacheable_response(self):
+        resp = self.client.get('/disable-analytics')
+        self.assert200(resp)
+        self.assertNotIn('Set-Cookie', resp.headers)
+        self.assertIn('Cookie', resp.headers['Vary'])
+
+    def test_consent_route_sets_cookie(self):
+        resp = self.client.post('/consent', json=['required'])
+        self.assertIn('Set-Cookie', resp.headers)
+
+
+class MetricsTest(TestCase):
+    def create_app(self):
+        app, self.consent = make_app_and_consent()
+        return app
+
+    def test_counters(self):
+        self.client.get('/banner')
+        self.client.post('/consent', json=['required'])
+        self.client.post('/consent', json=['required'])
+        self.client.post('/consent', json=['foo'])
+        metrics = self.consent.metrics
+        self.assertEqual(metrics.counter('banner_impressions_total'), 1)
+        self.assertEqual(metrics.counter('stale_total'), 1)
+        self.assertEqual(metrics.counter('cookies_total', status='missing'), 1)
+        self.assertEqual(metrics.counter('cookies_total', status='present'), 1)
+        self.assertEqual(metrics.counter('requests_total', method='POST', outcome='updated'), 1)
+        self.assertEqual(metrics.counter('requests_total', method='POST', outcome='unchanged'), 1)
+        self.assertEqual(metrics.counter('requests_total', method='POST', outcome='invalid_category'), 1)
+        self.assertEqual(metrics.timing('render_seconds')[0], 1)
+        self.assertEqual(metrics.timing('cookie_decode_seconds')[0], 2)
+
+    def test_prometheus(self):
+        self.client.post('/consent', json=['required'])
+        text = self.consent.export_metrics()
+        self.assertIn('# TYPE flask_consent_requests_total counter', text)
+        self.assertIn('flask_consent_requests_total{method="POST",outcome="updated"} 1', text)
+        self.assertIn('flask_consent_cookie_decode_seconds_count 1', text)
+
+    def test_disabled(self):
+        self.consent.metrics.enabled = False
+        self.client.get('/banner')
+        self.assertEqual(self.consent.metrics.counter('banner_impressions_total'), 0)
+
+    def test_signal(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs)
+
+        consent_requested.connect(receiver, self.app)
+        try:
+            self.client.post('/consent', json='foo')
+        finally:
+            consent_requested.disconnect(receiver, self.app)
+        self.assertListEqual(received, [dict(method='POST', outcome='invalid_payload')])
+
+
+class SyncTest(TestCase):
+    def create_app(self):
+        app, consent = make_app_and_consent(SECRET_KEY='secret', CONSENT_SYNC_MODE='redirect')
+
+        @consent.domain_loader
+        def domain_loader():
+            return ['secondary.test']
+
+        return app
+
+    def get_token(self):
+        self.client.post('/consent', json=['required', 'analytics'])
+        resp = self.client.get('/consent', content_type='application/json')
+        self.assert200(resp)
+        return resp.json['token']
+
+    def test_no_token_without_consent(self):
+        resp = self.client.get('/consent', content_type='application/json')
+        self.assertNotIn('token', resp.json)
+
+    def test_apply_token(self):
+        token = self.get_token()
+        other = self.app.test_client()
+        resp = other.post('/consent', json=dict(token=token))
+        self.assert200(resp)
+        self.assertSetEqual(set(resp.json['enabled']), {'required', 'analytics'})
+        self.assertIn('Set-Cookie', resp.headers)
+
+    def test_apply_invalid_token(self):
+        token = self.get_token()
+        resp = self.app.test_client().post('/consent', json=dict(token=token + 'x'))
+        self.assert400(resp)
+        self.assertDictEqual(resp.json, dict(msg='invalid sync token'))
+
+    def sync(self, client, **query):
+        return client.get('/consent/sync', query_string=query)
+
+    def test_redirect_flow(self):
+        self.get_token()
+        other = self.app.test_client()
+        resp = self.sync(other, next='/page?x=1')
+        self.assertStatus(resp, 302)
+        location = urlsplit(resp.headers['Location'])
+        self.assertEqual((location.netloc, location.path), ('primary.test', '/consent/sync'))
+        query = parse_qs(location.query)
+        self.assertListEqual(query['return'], ['http://localhost/page?x=1'])
+
+        resp = self.sync(self.client, **{'return': query['return'][0], 'nonce': query['nonce'][0]})
+        self.assertStatus(resp, 302)
+        location = urlsplit(resp.headers['Location'])
+        self.assertEqual((location.netloc, location.path), ('localhost', '/consent/sync'))
+        query = parse_qs(location.query)
+        self.assertListEqual(query['next'], ['/page?x=1'])
+
+        resp = self.sync(other, **{key: value[0] for key, value in query.items()})
+        self.assertStatus(resp, 302)
+        self.assertTrue(resp.headers['Location'].endswith('/page?x=1'))
+        self.assertIn('Set-Cookie', resp.headers)
+        resp = other.get('/')
+        self.assertDictEqual(resp.json, dict(required=True, preferences=False, analytics=True))
+
+    def test_redirect_token_needs_nonce(self):
+        token = self.get_token()
+        other = self.app.test_client()
+        defaults = other.get('/').json
+        # a link (or an <img>) pointing at the sync route with someone else's token
+        self.sync(other, token=token, next='/')
+        self.assertDictEqual(other.get('/').json, defaults)
+
+        resp = self.sync(other, next='/')
+        nonce = parse_qs(urlsplit(resp.headers['Location']).query)['nonce'][0]
+        self.sync(other, token=token, nonce=nonce + 'x', next='/')
+        self.assertDictEqual(other.get('/').json, defaults)
+
+    def test_token_does_not_override_consent(self):
+        token = self.get_token()
+        other = self.app.test_client()
+        other.post('/consent', json=['required'])
+        resp = other.post('/consent', json=dict(token=token))
+        self.assert200(resp)
+        self.assertListEqual(resp.json['enabled'], ['required'])
+
+    def test_redirect_without_consent(self):
+        resp = self.sync(self.client, **{'return': 'https://secondary.test/', 'nonce': 'abc'})
+        self.assertStatus(resp, 302)
+        query = parse_qs(urlsplit(resp.headers['Location']).query)
+        self.assertNotIn('token', query)
+        self.assertListEqual(query['nonce'], ['abc'])
+
+    def test_redirect_without_nonce(self):
+        self.get_token()
+        resp = self.sync(self.client, **{'return': 'https://secondary.test/'})
+        self.assertStatus(resp, 302)
+        self.assertNotIn('token', parse_qs(urlsplit(resp.headers['Location']).query))
+
+    def test_redirect_unknown_host(self):
+        resp = self.sync(self.client, **{'return': 'https://evil.test/'})
+        self.assert400(resp)
+
+    def test_redirect_next_must_be_local(self):
+        for next_url in ('https://evil.test/', '//evil.test/', '/\\evil.test/', '/\t/evil.test/', 'evil.test'):
+            for query in (dict(next=next_url), dict(next=next_url, nonce='abc')):
+                resp = self.sync(self.client, **query)
+                self.assertStatus(resp, 302)
+                self.assertNotIn('evil', resp.headers['Location'])
+
+    def test_sync_mode_in_config(self):
+        resp = self.client.get('/banner')
+        self.assertIn('"sync_mode": "redirect"', resp.data.decode(resp.charset))
+
+    def test_token_expires(self):
+        tokens = SyncTokens('secret', max_age=-1)
+        self.assertIsNone(tokens.loads(tokens.dumps({'required'}, datetime.utcnow())))
+
+
+class CorsTest(TestCase):
+    def create_app(self):
+        app, consent = make_app_and_consent(CONSENT_CACHE_FULL_PAGE=True)
+        self.loads = 0
+
+        @consent.domain_loader
+        def domain_loader():
+            self.loads += 1
+            return ['secondary.test']
+
+        return app
+
+    def test_preflight(self):
+        resp = self.client.options('/consent', headers={'Origin': 'https://secondary.test',
+                                                        'Access-Control-Request-Method': 'POST',
+                                                        'Access-Control-Request-Headers': 'Content-Type'})
+        self.assertStatus(resp, 204)
+        self.assertEqual(resp.headers['Access-Control-Allow-Origin'], 'https://secondary.test')
+        self.assertEqual(resp.headers['Access-Control-Allow-Credentials'], 'true')
+        self.assertIn('POST', resp.headers['Access-Control-Allow-Methods'])
+        self.assertEqual(resp.headers['Access-Control-Allow-Headers'], 'Content-Type')
+        self.assertEqual(resp.headers['Access-Control-Max-Age'], '86400')
+        self.assertNotIn('Set-Cookie', resp.headers)
+
+    def test_preflight_unknown_origin(self):
+        resp = self.client.options('/consent', headers={'Origin': 'https://evil.test'})
+        self.assertStatus(resp, 204)
+        self.assertNotIn('Access-Control-Allow-Origin', resp.headers)
+
+    def test_json_response_allows_origin(self):
+        resp = self.client.get('/consent', headers={'Origin': 'https://primary.test'},
+                               content_type='application/json')
+        self.assert200(resp)
+        self.assertEqual(resp.headers['Access-Control-Allow-Origin'], 'https://primary.test')
+        self.assertIn('Origin', resp.headers['Vary'])
+        self.assertEqual(resp.headers.getlist('Access-Control-Allow-Credentials'), ['true'])
+
+    def test_domains_loaded_once_per_request(self):
+        self.client.get('/consent', headers={'Origin': 'https://secondary.test'}, content_type='application/json')
+        self.assertEqual(self.loads, 1)
+        self.loads = 0
+        resp = self.client.get('/consent')
+        self.assert200(resp)
+        self.assertIn('secondary.test', resp.data.decode(resp.charset))
+        self.assertEqual(self.loads, 1)
+
+
+class ExemptTest(TestCase):
+    def create_app(self):
+        app, consent = make_app_and_consent(CONSENT_EXEMPT=['/internal'])
+        self.predicate_calls = []
+
+        @app.route('/health')
+        @consent.exempt
+        def health():
+            return jsonify(analytics=request.consent['analytics'])
+
+        @app.route('/internal/status')
+        def status():
+            return jsonify(analytics=request.consent['analytics'])
+
+        api = Blueprint('api', __name__)
+
+        @api.route('/api/consent')
+        def api_consent():
+            request.consent['analytics'] = False
+            return jsonify()
+
+        consent.exempt(api)
+        app.register_blueprint(api)
+
+        @app.route('/metrics')
+        def metrics():
+            return jsonify(analytics=request.consent['analytics'])
+
+        @consent.exempt_when
+        def is_metrics(endpoint):
+            self.predicate_calls.append(endpoint)
+            return endpoint == 'metrics'
+
+        return app
+
+    def test_exempt_uses_defaults(self):
+        self.client.post('/consent', json=['required'])
+        for url in ('/health', '/internal/status', '/metrics'):
+            resp = self.client.get(url)
+            self.assert200(resp)
+            self.assertDictEqual(resp.json, dict(analytics=True))
+        resp = self.client.get('/')
+        self.assertDictEqual(resp.json, dict(required=True, preferences=False, analytics=False))
+
+    def test_exempt_is_read_only(self):
+        resp = self.client.get('/api/consent')
+        self.assert500(resp)
+        with self.assertRaises(RuntimeError):
+            self.consent_state().default_consent['analytics'] = False
+
+    def test_predicate_called_once(self):
+        self.client.get('/metrics')
+        self.client.get('/metrics')
+        self.assertEqual(self.predicate_calls.count('metrics'), 1)
+
+    def test_consent_route_not_exempt(self):
+        self.assertFalse(self.consent_state().is_exempt('flask_consent'))
+        self.assertTrue(self.consent_state().is_exempt('status'))
+        self.assertTrue(self.consent_state().is_exempt('api.api_consent'))
+        self.assertFalse(self.consent_state().is_exempt('static'))
+
+    def consent_state(self):
+        return self.app.extensions['consent']
+
+
+class DomainCacheTest(TestCase):
+    def create_app(self):
+        app, self.consent = make_app_and_consent(CONSENT_DOMAINS_TTL=60)
+        self.loads = 0
+
+        @self.consent.domain_loader
+        def domain_loader():
+            self.loads += 1
+            return ['secondary.test']
+
+        return app
+
+    def test_cached(self):
+        self.assertListEqual(self.consent.domains, ['secondary.test'])
+        self.assertListEqual(self.consent.domains, ['secondary.test'])
+        self.assertEqual(self.loads, 1)
+
+    def test_invalidate(self):
+        self.consent.domains
+        self.consent.invalidate_domains()
+        self.consent.domains
+        self.assertEqual(self.loads, 2)
+
+    def test_stale_refreshed_in_background(self):
+        self.app.config['CONSENT_DOMAINS_TTL'] = 0.01
+        self.consent.reload_settings()
+        self.consent.domains
+        time.sleep(0.02)
+        self.assertListEqual(self.consent.domains, ['secondary.test'])
+        for _ in range(100):
+            if self.loads == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.loads, 2)
+
+    def test_disabled(self):
+        self.app.config['CONSENT_DOMAINS_TTL'] = 0
+        self.consent.reload_settings()
+        self.consent.domains
+        self.consent.domains
+        self.assertEqual(self.loads, 2)
+
+    def test_async_loader(self):
+        @self.consent.domain_loader
+        async def domain_loader():
+            return ['async.test']
+
+        self.assertListEqual(self.consent.domains, ['async.test'])
+
+
+class AsyncDomainsTest(TestCase):
+    def create_app(self):
+        app, self.consent = make_app_and_consent(CONSENT_DOMAINS_TTL=60)
+        self.loads = 0
+        return app
+
+    def test_async_loader_shared(self):
+        @self.consent.domain_loader
+        async def domain_loader():
+            self.loads += 1
+            await asyncio.sleep(0.01)
+            return ['async.test']
+
+        async def lookup():
+            return await asyncio.gather(*(self.consent.domains_async() for _ in range(5)))
+
+        self.assertEqual(asyncio.run(lookup()), [['async.test']] * 5)
+        self.assertEqual(self.loads, 1)
+
+    def test_sync_loader_runs_in_executor(self):
+        threads = []
+
+        @self.consent.domain_loader
+        def domain_loader():
+            threads.append(threading.current_thread())
+            return [request.host]
+
+        self.assertListEqual(asyncio.run(self.consent.domains_async()), ['localhost'])
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_remembered_for_request(self):
+        @self.consent.domain_loader
+        async def domain_loader():
+            self.loads += 1
+            return ['async.test']
+
+        self.app.config['CONSENT_DOMAINS_TTL'] = 0
+        self.consent.reload_settings()
+        asyncio.run(self.consent.domains_async())
+        self.assertListEqual(self.consent.domains, ['async.test'])
+        self.assertEqual(self.loads, 1)
+
+
+@unittest.skipUnless(importlib.util.find_spec('asgiref'), 'async views need Flask[async]')
+class AsyncRouteTest(TestCase):
+    def create_app(self):
+        app, consent = make_app_and_consent(CONSENT_ASYNC=True)
+
+        @consent.domain_loader
+        async def domain_loader():
+            return ['secondary.test']
+
+        return app
+
+    def test_json(self):
+        resp = self.client.get('/consent', headers={'Origin': 'https://secondary.test'},
+                               content_type='application/json')
+        self.assert200(resp)
+        self.assertEqual(resp.headers['Access-Control-Allow-Origin'], 'https://secondary.test')
+
+    def test_post(self):
+        resp = self.client.post('/consent', json=['required'])
+        self.assert200(resp)
+        self.assertIn('Set-Cookie', resp.headers)
+
+
+class WarmupTest(unittest.TestCase):
+    def setUp(self):
+        self.app, self.consent = make_app_and_consent()
+        self.renders = []
+
+        def recording_render(template, **kwargs):
+            self.renders.append(template)
+            return render_template(template, **kwargs)
+
+        self.consent.set_render_template_func(recording_render)
+
+    def test_warmup(self):
+        timings = self.consent.warmup(self.app)
+        self.assertListEqual(list(timings), ['injection_template', 'script', 'exemptions', 'default_consent',
+                                             'banner', 'full_template'])
+        self.assertTrue(all(t is not None and t >= 0 for t in timings.values()))
+        self.assertEqual(self.renders, ['banner.html'])
+        self.app.test_client().get('/banner')
+        self.assertEqual(self.renders, ['banner.html'])
+
+    def test_domains_cached(self):
+        self.app, self.consent = make_app_and_consent(CONSENT_DOMAINS_TTL=60)
+        calls = []
+
+        @self.consent.domain_loader
+        def domain_loader():
+            calls.append(1)
+            return ['secondary.test']
+
+        self.assertIn('domains', self.consent.warmup(self.app))
+        self.app.test_client().get('/banner')
+        self.assertEqual(len(calls), 1)
+
+    def test_failing_step(self):
+        self.app, self.consent = make_app_and_consent(CONSENT_DOMAINS_TTL=60)
+
+        @self.consent.domain_loader
+        def domain_loader():
+            raise ConnectionError('database not ready')
+
+        self.app.logger.disabled = True
+        timings = self.consent.warmup(self.app)
+        self.assertIsNone(timings['domains'])
+        self.assertIsNotNone(timings['script'])
+
+    def test_cli(self):
+        result = self.app.test_cli_runner().invoke(args=['consent', 'warmup'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('injection_template', result.output)
+
+
 class BasicTest(unittest.TestCase):
     def test_double_register(self):
         app = Flask(__name__)
@@ -160,3 +912,40 @@ class BasicTest(unittest.TestCase):
             self.assertIs(data[preferences_category], True)
             data[preferences_category] = False
             self.assertIs(data[preferences_category], False)
+
+    def test_settings_snapshot(self):
+        app = Flask(__name__)
+        app.config['CONSENT_PRIMARY_SERVERNAME'] = 'primary.test:5000'
+        consent = Consent(app)
+        settings = app.extensions['consent'].settings
+        self.assertEqual(settings.primary_domain, 'primary.test')
+        self.assertEqual(settings.max_age, 365 * 24 * 60 * 60)
+
+        app.config['CONSENT_COOKIE_NAME'] = 'other'
+        self.assertEqual(app.extensions['consent'].settings.cookie_name, '_consent')
+        consent.reload_settings(app)
+        self.assertEqual(app.extensions['consent'].settings.cookie_name, 'other')
+
+    def test_lazy_load(self):
+        app = Flask(__name__)
+        consent = Consent(app)
+        consent.add_standard_categories()
+
+        decoded = []
+
+        def receiver(sender, **kwargs):
+            decoded.append(kwargs['status'])
+
+        cookie_decoded.connect(receiver, app)
+        try:
+            with app.test_request_context(headers={'Cookie': '_consent=this-is-not-json'}):
+                app.preprocess_request()
+                app.process_response(app.response_class())
+            self.assertListEqual(decoded, [])
+
+            with app.test_request_context():
+                app.preprocess_request()
+                self.assertIs(request.consent['required'], True)
+            self.assertListEqual(decoded, ['missing'])
+        finally:
+            cookie_decoded.disconnect(receiver, app)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Flask-Consent
+# Copyright (C) 2020 Jan Dalheimer
+
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from flask import request
+from flask_testing import TestCase
+
+from flask_consent import ConsentCookie, JsonCookieCodec
+from flask_consent.store import CachedConsentStore, SQLiteConsentStore, StoredConsent
+
+from test_consent import make_app_and_consent
+
+
+class CountingStore(SQLiteConsentStore):
+    def __init__(self):
+        super().__init__(':memory:')
+        self.gets = 0
+
+    def get(self, user_id):
+        self.gets += 1
+        return super().get(user_id)
+
+
+class StoreTest(unittest.TestCase):
+    def test_sqlite_roundtrip(self):
+        store = SQLiteConsentStore(':memory:')
+        self.assertIsNone(store.get(1))
+        consent = StoredConsent(frozenset({'required'}), datetime(2020, 7, 18))
+        store.set(1, consent)
+        self.assertEqual(store.get(1), consent)
+        store.set(1, StoredConsent(frozenset(), datetime(2020, 7, 19), frozenset({'required', 'analytics'})))
+        self.assertEqual(store.get(1).enabled, frozenset())
+        self.assertEqual(store.get(1).decided, {'required', 'analytics'})
+
+    def test_sqlite_adds_decided_column(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'consent.db')
+            with sqlite3.connect(path) as connection:
+                connection.execute('CREATE TABLE flask_consent (user_id TEXT PRIMARY KEY, enabled TEXT NOT NULL, '
+                                   'last_updated TEXT NOT NULL)')
+                connection.execute('INSERT INTO flask_consent VALUES (?, ?, ?)',
+                                   ('1', '["required"]', '2020-07-18T00:00:00'))
+            connection.close()
+            store = SQLiteConsentStore(path)
+            self.assertEqual(store.get('1'), StoredConsent(frozenset({'required'}), datetime(2020, 7, 18)))
+            store.set('2', StoredConsent(frozenset(), datetime(2020, 7, 18), frozenset({'required'})))
+            self.assertEqual(store.get('2').decided, {'required'})
+            store.close()
+
+    def test_cache_reads_through(self):
+        backend = CountingStore()
+        store = CachedConsentStore(backend, maxsize=2, ttl=60)
+        self.assertIsNone(store.get(1))
+        self.assertIsNone(store.get(1))
+        self.assertEqual(backend.gets, 1)
+        store.set(1, StoredConsent(frozenset({'required'}), datetime(2020, 7, 18)))
+        self.assertEqual(store.get(1).enabled, {'required'})
+        self.assertEqual(backend.gets, 1)
+
+    def test_cache_evicts(self):
+        backend = CountingStore()
+        store = CachedConsentStore(backend, maxsize=2, ttl=60)
+        store.get(1)
+        store.get(2)
+        store.get(3)
+        store.get(1)
+        self.assertEqual(backend.gets, 4)
+
+    def test_cache_expires(self):
+        backend = CountingStore()
+        store = CachedConsentStore(backend, ttl=0)
+        store.get(1)
+        store.get(1)
+        self.assertEqual(backend.gets, 2)
+
+
+class WriteCountingStore(SQLiteConsentStore):
+    def __init__(self):
+        super().__init__(':memory:')
+        self.sets = 0
+
+    def set(self, user_id, consent):
+        self.sets += 1
+        super().set(user_id, consent)
+
+
+class StoreIntegrationTest(TestCase):
+    def create_app(self):
+        app, consent = make_app_and_consent()
+        self.store = WriteCountingStore()
+        consent.set_store(self.store)
+
+        @consent.user_loader
+        def user_loader():
+            return request.headers.get('X-User')
+
+        return app
+
+    def test_stored_consent_used(self):
+        self.store.set('alice', StoredConsent(frozenset({'required'}), datetime.utcnow()))
+        resp = self.client.get('/banner', headers={'X-User': 'alice'})
+        self.assertNotIn('id="flask_consent_banner"', resp.data.decode(resp.charset))
+        self.assertIn('Set-Cookie', resp.headers)
+        resp = self.client.get('/')
+        self.assertDictEqual(resp.json, dict(required=True, preferences=False, analytics=False))
+
+    def test_anonymous_uses_cookie(self):
+        self.store.set('alice', StoredConsent(frozenset({'required'}), datetime.utcnow()))
+        resp = self.client.get('/banner')
+        self.assertIn('id="flask_consent_banner"', resp.data.decode(resp.charset))
+
+    def test_consent_written_through(self):
+        self.client.post('/consent', json=['required', 'analytics'], headers={'X-User': 'bob'})
+        self.assertEqual(self.store.get('bob').enabled, {'required', 'analytics'})
+
+    def test_newer_cookie_wins(self):
+        self.store.set('carol', StoredConsent(frozenset({'required'}), datetime.utcnow() - timedelta(days=1)))
+        self.client.post('/consent', json=['required', 'preferences'])
+        resp = self.client.get('/', headers={'X-User': 'carol'})
+        self.assertDictEqual(resp.json, dict(required=True, preferences=True, analytics=False))
+        self.assertEqual(self.store.get('carol').enabled, {'required', 'preferences'})
+
+    def test_no_writes_after_consent(self):
+        self.client.post('/consent', json=['required', 'analytics'], headers={'X-User': 'dave'})
+        self.assertEqual(self.store.sets, 1)
+        for _ in range(2):
+            resp = self.client.get('/', headers={'X-User': 'dave'})
+            self.assertNotIn('Set-Cookie', resp.headers)
+        self.assertEqual(self.store.sets, 1)
+
+    def test_stored_microseconds_not_newer(self):
+        self.store.set('erin', StoredConsent(frozenset({'required'}), datetime.utcnow().replace(microsecond=999999)))
+        self.store.sets = 0
+        resp = self.client.get('/', headers={'X-User': 'erin'})
+        self.assertIn('Set-Cookie', resp.headers)
+        resp = self.client.get('/', headers={'X-User': 'erin'})
+        self.assertNotIn('Set-Cookie', resp.headers)
+        self.assertEqual(self.store.sets, 0)
+
+    def test_json_cookie_microseconds_not_newer(self):
+        # cookies written by earlier releases are JSON, with microseconds in the timestamp
+        given = datetime.utcnow().replace(microsecond=123456)
+        self.client.set_cookie('localhost', '_consent', JsonCookieCodec().encode(
+            self.app.extensions['consent'].extension.categories, ConsentCookie({'required'}, given)))
+        for _ in range(3):
+            resp = self.client.get('/', headers={'X-User': 'heidi'})
+            self.assertNotIn('Set-Cookie', resp.headers)
+        self.assertEqual(self.store.sets, 1)
+        self.assertEqual(self.store.get('heidi').enabled, {'required'})
+
+    def test_stored_decided_used(self):
+        self.store.set('frank', StoredConsent(frozenset({'required'}), datetime.utcnow(),
+                                              frozenset({'required', 'preferences'})))
+        resp = self.client.get('/banner', headers={'X-User': 'frank'})
+        # analytics was added after frank decided, so it starts out with its default and the banner asks about it
+        self.assertIn('id="flask_consent_banner"', resp.data.decode(resp.charset))
+        resp = self.client.get('/', headers={'X-User': 'frank'})
+        self.assertDictEqual(resp.json, dict(required=True, preferences=False, analytics=True))
+
+    def test_decided_written_through(self):
+        self.client.post('/consent', json=dict(enabled=['analytics'], categories=['analytics']),
+                         headers={'X-User': 'grace'})
+        self.assertEqual(self.store.get('grace').decided, {'analytics'})